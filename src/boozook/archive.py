@@ -51,6 +51,8 @@ class GameBase:
     restricted_patches: Optional[Set[str]] = None
 
     _patched: dict[tuple[str, str], bytes] = field(default_factory=dict)
+    # resources read from game files, dropped when the game is rebuilt
+    cache: dict[str, object] = field(default_factory=dict)
 
     def search(self, patterns):
         return game_search(self.base_dir, patterns=patterns, patches=self.patches)
@@ -66,6 +68,7 @@ class GameBase:
         self._patched[(fname, alias)] = data
 
     def rebuild(self, target='.'):
+        self.cache.clear()
         target = Path(target)
         os.makedirs(target, exist_ok=True)
         patches = defaultdict(dict)
@@ -1,9 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial, wraps
 from itertools import chain, takewhile
 import operator
 from typing import (
     Callable,
     Iterable,
+    Iterator,
     Optional,
     Protocol,
     TypeVar,
@@ -46,6 +48,17 @@ def collect(
     return decorator
 
 
+def parallel_map(
+    func: Callable[..., ResultT], *iterables: Iterable, jobs: int = 1
+) -> Iterator[ResultT]:
+    # results are yielded in input order, workers are used only when jobs > 1
+    if jobs <= 1:
+        yield from map(func, *iterables)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(func, *iterables)
+
+
 def read_uint16_le(stream: SupportsRead[bytes]) -> int:
     return int.from_bytes(stream.read(2), byteorder='little', signed=False)
 
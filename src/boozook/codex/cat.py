@@ -1,11 +1,10 @@
-from collections.abc import Iterator
-import io
-import operator
+from collections.abc import Iterator, Mapping
 import os
 from enum import IntEnum
-from itertools import groupby
-from typing import Iterable, cast
 from boozook.archive import GameBase
+from boozook.codex.base import parallel_map
+
+import numpy as np
 
 from pakal.archive import ArchivePath
 
@@ -26,63 +25,85 @@ class Language(IntEnum):
     IDE = 9
 
 
+def read_table(data: bytes) -> tuple[bytes, np.ndarray, int]:
+    # fixed size records: (languages, messages, line) with missing records zeroed,
+    # a truncated last record is counted and padded with zeros
+    version = data[:18]
+    num_messages = version[4]
+    size = len(Language) * num_messages
+    available = min(size * LINE_SIZE, max(0, len(data) - len(version)))
+    count = -(-available // LINE_SIZE)
+    table = np.zeros(size * LINE_SIZE, dtype=np.uint8)
+    table[:available] = np.frombuffer(
+        data, dtype=np.uint8, count=available, offset=len(version)
+    )
+    return version, table.reshape(len(Language), num_messages, LINE_SIZE), count
+
+
+def compose_file(data: bytes, cgroup: list[dict[str, bytes | None]]) -> bytes:
+    version = data[:18]
+    num_messages = version[4]
+    assert len(cgroup) == num_messages, (len(cgroup), num_messages)
+    texts = [line[lang.name] or b'' for lang in Language for line in cgroup]
+    if any(text[LINE_SIZE:].strip(b'~\0') for text in texts):
+        raise ValueError(
+            'Non-null characters after 40 characters limit',
+        )
+    table = np.array(texts, dtype=f'S{LINE_SIZE}').view(np.uint8)
+    table[table == ord('~')] = 0
+    composed = version + table.tobytes()
+    if len(data) < len(composed):
+        # truncated files keep their length unless the texts need more
+        used = np.flatnonzero(table)
+        end = len(version) + (int(used[-1]) + 1 if len(used) else 0)
+        composed = composed[: max(len(data), end)]
+    return composed
+
+
 def compose(
     game: GameBase,
-    lines: Iterable[tuple[str, dict[str, bytes | None]]],
+    lines: Mapping[str, list[dict[str, bytes | None]]],
+    jobs: int = 1,
 ) -> None:
-    grouped = groupby(lines, key=operator.itemgetter(0))
-    for tfname, group in grouped:
-        basename = os.path.basename(tfname)
-        cgroup = list(group)
-        for pattern, entry in game.search([basename]):
-            with entry.open('rb') as f, io.BytesIO() as output:
-                version = f.read(18)
-                num_messages = version[4]
-                output.write(version)
-
-                for lang in Language:
-                    pos = len(version) + lang * num_messages * LINE_SIZE
-                    assert output.tell() == pos, (output.tell(), pos)
-                    for _, line in cgroup:
-                        enc = line[lang.name]
-                        if enc is None:
-                            output.seek(LINE_SIZE, io.SEEK_CUR)
-                            continue
-                        enc = enc.replace(b'~', b'\0')
-                        towrite = enc.ljust(LINE_SIZE, b'\0')
-                        if sum(towrite[40:]) > 0:
-                            raise ValueError(
-                                'Non-null characters after 40 characters limit',
-                            )
-                        towrite = towrite[:40]
-                        assert len(towrite) == LINE_SIZE, len(towrite)
-                        output.write(towrite)
+    basenames = {os.path.basename(tfname).upper(): tfname for tfname in lines}
+    sources: dict[str, tuple[bytes, list[dict[str, bytes | None]]]] = {}
+    found = set()
+    for pattern, entry in game.search(['*.CAT']):
+        key = entry.name.upper()
+        if key in basenames and key not in found:
+            found.add(key)
+            sources[entry.name] = (entry.read_bytes(), lines[basenames[key]])
+    for basename, tfname in basenames.items():
+        if basename not in found:
+            raise ValueError(f'entry {os.path.basename(tfname)} was not found')
 
-                # force write at current stream position (fill with zeros)
-                output.write(b'\0')
-                game.patch(
-                    entry.name,
-                    output.getvalue()[:-1],
-                )
+    names = list(sources)
+    composed = parallel_map(
+        compose_file,
+        *zip(*(sources[name] for name in names)),
+        jobs=jobs,
+    )
+    for name, data in zip(names, composed):
+        game.patch(name, data)
 
 
 def write_parsed(
     game: GameBase,
     entry: ArchivePath,
 ) -> Iterator[dict[str, bytes | None]]:
-    with entry.open('rb') as f:
-        version = f.read(18)
-        num_messages = version[4]
-        print(version)
-        text_line: list[dict[str, bytes | None]] = [{} for num in range(num_messages)]
-        for lang in Language:
-            for num in range(num_messages):
-                line = cast(bytes, f.read(LINE_SIZE))
-                if not line:
-                    break
-                # line, rest = line.split(b'\0', maxsplit=1)
-                # assert set(rest) == {0} or set(rest) == {0, ord(' ')}, rest
-                assert b'~' not in line, line
-                line = line.replace(b'\0', b'~')
-                text_line[num][lang.name] = line
-        yield from text_line
+    data = entry.read_bytes()
+    version, table, count = read_table(data)
+    print(version)
+    assert not (table == ord('~')).any(), table
+    table[table == 0] = ord('~')
+    lines = table.view(f'S{LINE_SIZE}')[..., 0].tolist()
+    text_line: list[dict[str, bytes | None]] = [{} for num in range(version[4])]
+    for pos in range(count):
+        lang, num = divmod(pos, version[4])
+        text_line[num][Language(lang).name] = lines[lang][num]
+    # the truncated last record is read as a shorter line
+    partial = (len(data) - len(version)) - (count - 1) * LINE_SIZE
+    if count and partial < LINE_SIZE:
+        lang, num = divmod(count - 1, version[4])
+        text_line[num][Language(lang).name] = lines[lang][num][:partial]
+    yield from text_line
@@ -1,8 +1,7 @@
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass
+from functools import cached_property
 from typing import Mapping, Protocol
 
-from boozook.codex.stk import replace_many
-
 
 class TextEncoder(Protocol):
     def decode(self, text: bytes) -> str:
@@ -18,10 +17,10 @@ class CodePageEncoder:
     errors: str = 'strict'
 
     def decode(self, text: bytes) -> str:
-        return text.decode(**asdict(self))
+        return text.decode(self.encoding, self.errors)
 
     def encode(self, text: str) -> bytes:
-        return text.encode(**asdict(self))
+        return text.encode(self.encoding, self.errors)
 
 
 @dataclass
@@ -29,16 +28,20 @@ class KeyReplacer:
     codepage: CodePageEncoder
     mapping: Mapping[str, str]
 
+    # all keys are replaced in a single pass, so replaced text is never replaced again
+    @cached_property
+    def decode_table(self) -> dict[int, str]:
+        return str.maketrans(dict(self.mapping))
+
+    @cached_property
+    def encode_table(self) -> dict[int, str]:
+        return str.maketrans({v: k for k, v in self.mapping.items()})
+
     def decode(self, text: bytes) -> str:
-        return replace_many(self.codepage.decode(text), *self.mapping.items())
+        return self.codepage.decode(text).translate(self.decode_table)
 
     def encode(self, text: str) -> bytes:
-        return self.codepage.encode(
-            replace_many(
-                text,
-                *((v, k) for k, v in self.mapping.items()),
-            )
-        )
+        return self.codepage.encode(text.translate(self.encode_table))
 
 
 HebrewKeyReplacer = KeyReplacer(
@@ -98,3 +101,47 @@ def encrypt(
     if line is None or line == '---':
         return None
     return crypts[lang].encode(line)
+
+
+def bench(count=20000, repeat=5):
+    import csv
+    import io
+    import random
+    import timeit
+
+    from boozook.text import LANGS, encrypt_texts, format_rows, text_codecs
+
+    crypts = text_codecs(keys=True)
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz,.;/\''
+    words = [''.join(rand.choices(letters, k=rand.randint(1, 9))) for _ in range(500)]
+    rows = [
+        {
+            lang: crypts[lang].encode(' '.join(rand.choices(words, k=8)))
+            for lang in ('INT', 'ANG', 'ISR')
+        }
+        for _ in range(count)
+    ]
+    header = '\t'.join(['FILE', *LANGS]) + '\n'
+
+    def export():
+        return header + format_rows('BENCH.TOT', rows, crypts)
+
+    def reimport(tsv):
+        with io.StringIO(tsv) as stream:
+            lines = csv.DictReader(stream, delimiter='\t')
+            return [text for _, text in encrypt_texts(crypts, lines)]
+
+    tsv = export()
+    imported = [
+        {lang: line for lang, line in texts.items() if line is not None}
+        for texts in reimport(tsv)
+    ]
+    assert imported == rows
+    for name, func in (('export', export), ('import', lambda: reimport(tsv))):
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f'{name}: {count} rows in {best:.3f}s ({count / best:,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,30 +1,87 @@
-from collections import defaultdict
-from contextlib import redirect_stdout
+import bisect
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field, fields, replace
 from functools import partial
+import gzip
+import hashlib
 import io
+import json
 import os
 from pathlib import Path
+import struct
+import time
 from boozook import archive
-from boozook.codex import tot
-from boozook.codex.crypt import CodePageEncoder, HebrewKeyReplacer
-from boozook.codex.ext import read_ext_table
+from boozook.codex import tot, xref
+from boozook.codex.base import parallel_map
+from boozook.codex.crypt import decrypt
+from boozook.codex.ext import ResourceTable, open_commun
 from boozook.codex.let import read_sint16le
-from boozook.codex.stk import replace_many, unpack_chunk
-from boozook.text import decrypt
+from boozook.text import text_codecs
 
 from boozook.totfile import (
-    read_tot,
+    TotFile,
     read_uint16le,
-    read_uint32le,
     reads_uint16le,
-    reads_uint32le,
 )
 
 
-def peek_uint8(scf):
-    res = ord(scf.read(1))
-    scf.seek(-1, 1)
-    return res
+UINT16LE = struct.Struct('<H')
+UINT32LE = struct.Struct('<I')
+
+
+class BytecodeCursor:
+    # position over the script buffer, with the BinaryIO subset used by the decoder
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = offset
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        start = self.pos
+        end = len(self.view) if size < 0 else min(start + size, len(self.view))
+        self.pos = max(start, end)
+        return bytes(self.view[start:end])
+
+    def peek(self) -> int:
+        return self.view[self.pos]
+
+    def u8(self) -> int:
+        value = self.view[self.pos]
+        self.pos += 1
+        return value
+
+    def u16(self) -> int:
+        (value,) = UINT16LE.unpack_from(self.view, self.pos)
+        self.pos += 2
+        return value
+
+    def u32(self) -> int:
+        (value,) = UINT32LE.unpack_from(self.view, self.pos)
+        self.pos += 4
+        return value
+
+    def cstring(self) -> str:
+        end = self.data.find(b'\0', self.pos)
+        if end < 0:
+            end = len(self.data)
+        value = self.data[self.pos : end]
+        self.pos = end + 1
+        return value.decode('ascii', errors='ignore')
 
 
 OPERATORS = {
@@ -50,137 +107,178 @@ OPERATORS = {
 }
 
 
-def read_str(stream):
-    return b''.join(iter(partial(stream.read, 1), b'\00')).decode(
-        'ascii', errors='ignore'
-    )
+@dataclass
+class Const:
+    value: int
 
 
-def paren(func):
-    def inner(*args, **kwargs):
-        res = func(*args, **kwargs)
-        if ' ' in res:
-            return f'({res})'
-        return res
+@dataclass
+class Str:
+    value: str
 
-    return inner
+
+@dataclass
+class Op:
+    symbol: str
+
+
+@dataclass
+class Mark:
+    # raw text kept inside an expression, end markers and undecoded operators
+    text: str
+
+
+@dataclass
+class Ptr:
+    # base offset prefix, array offsets carry their index expressions
+    base: int
+    dims: list | None = None
 
 
-@paren
-def read_expr(scf, stop=99):
+@dataclass
+class Var:
+    size: int | None
+    offset: int
+    prefix: list = field(default_factory=list)
+    dims: list | None = None
+    address: bool = False
+    suffix: 'Expr | None' = None
+
+
+@dataclass
+class Call:
+    func: str
+    args: 'Expr'
+
+
+@dataclass
+class Expr:
+    # operands and operators in bytecode order
+    items: list
+
+
+@dataclass
+class Concat:
+    # handler output around expressions, parts are text or nodes
+    parts: list
+
+
+FUNCS = {
+    5: 'sqr',
+    10: 'rand',
+    7: 'abs',
+    0: 'sqrt',
+    1: 'sqrt',
+    6: 'sqrt',
+}
+
+
+def read_dims(ctx, scf):
+    dim_count = scf.u8()
+    arr_desc = scf.read(dim_count)
+    return [
+        (read_expr(ctx, scf, 12), read_uint16le(arr_desc[2 * dim : 2 * (dim + 1)]))
+        for dim in range(dim_count)
+    ]
+
+
+def read_expr(ctx, scf, stop=99):
     num = 0
-    expr = ''
+    items = []
     # print('BEGIN READ_EXPR')
     while True:
-        operation = scf.read(1)[0]
+        operation = scf.u8()
 
         # print('OPERATION', operation)
 
-        # var_base = 0
+        prefix = []
         while operation in {14, 15}:
             if operation == 14:
-                expr += '#{:d}#'.format(read_uint16le(scf.read(2)) * 4)
+                prefix.append(Ptr(scf.u16() * 4))
 
                 _skip = scf.read(2)
-                if peek_uint8(scf) == 97:
+                if scf.peek() == 97:
                     _skip = scf.read(1)
 
             elif operation == 15:
-                expr += '#{:d}->'.format(read_uint16le(scf.read(2)) * 4)
+                base = scf.u16() * 4
 
-                offset1 = read_uint16le(scf.read(2))
+                offset1 = scf.u16()
 
-                dim_count = scf.read(1)[0]
+                dim_count = scf.u8()
                 dim_array = scf.read(dim_count)
 
-                for i in range(dim_count):
-                    expr += read_expr(scf, 12) + '->'
+                dims = [read_expr(ctx, scf, 12) for i in range(dim_count)]
+                prefix.append(Ptr(base, dims))
 
-                expr += '#'
-
-                if peek_uint8(scf) == 97:
+                if scf.peek() == 97:
                     _skip = scf.read(1)
 
-            operation = scf.read(1)[0]
+            operation = scf.u8()
+        items.extend(prefix)
 
         if 16 <= operation <= 29:
             if operation == 17:
-                expr += 'var16_{:d}'.format(read_uint16le(scf.read(2)) * 2)
+                items.append(var_ref(ctx, Var(16, scf.u16() * 2), prefix))
             elif operation == 18:
-                expr += 'var8_{:d}'.format(read_uint16le(scf.read(2)))
+                items.append(var_ref(ctx, Var(8, scf.u16()), prefix))
             elif operation == 19:
-                expr += '{:d}'.format(read_uint32le(scf.read(4)))
+                items.append(Const(scf.u32()))
 
             elif operation == 20:
-                expr += '{:d}'.format(read_uint16le(scf.read(2)))
+                items.append(Const(scf.u16()))
 
             elif operation == 21:
-                expr += '{:d}'.format(scf.read(1)[0])
+                items.append(Const(scf.u8()))
             elif operation == 22:
-                expr += '"{}"'.format(read_str(scf))
+                items.append(Str(scf.cstring()))
 
             elif operation in {23, 24}:
-                expr += 'var32_{:d}'.format(read_uint16le(scf.read(2)) * 4)
+                items.append(var_ref(ctx, Var(32, scf.u16() * 4), prefix))
             elif operation == 25:
-                expr += '(&var8_{:d})'.format(read_uint16le(scf.read(2)) * 4)
-                if peek_uint8(scf) == 13:
+                var = var_ref(ctx, Var(8, scf.u16() * 4, address=True), prefix)
+                if scf.peek() == 13:
                     _skip = scf.read(1)
-                    expr += '+{*'
-                    expr += read_expr(scf, 12)
+                    var.suffix = read_expr(ctx, scf, 12)
+                items.append(var)
 
             elif operation in {16, 26, 27, 28}:
-                temp = read_uint16le(scf.read(2))
+                temp = scf.u16()
                 if operation == 16:
-                    expr += 'var8_{:d}['.format(temp)
+                    var = Var(8, temp)
                 elif operation == 26:
-                    expr += 'var32_{:d}['.format(temp * 4)
+                    var = Var(32, temp * 4)
                 elif operation == 27:
-                    expr += 'var16_{:d}['.format(temp * 2)
+                    var = Var(16, temp * 2)
                 elif operation == 28:
-                    expr += '(&var8_{:d}['.format(temp * 4)
-                dim_count = scf.read(1)[0]
-                arr_desc = scf.read(dim_count)
-                offset = 0
-                for dim in range(dim_count):
-                    expr += read_expr(scf, 12) + ' of {:d}'.format(
-                        read_uint16le(arr_desc[2 * dim : 2 * (dim + 1)])
-                    )
-                    if dim < dim_count - 1:
-                        expr += ']['
-                expr += ']'
-
-                if operation == 28:
-                    expr += ')'
-                if operation == 28 and peek_uint8(scf) == 13:
+                    var = Var(8, temp * 4, address=True)
+                var = var_ref(ctx, var, prefix)
+                var.dims = read_dims(ctx, scf)
+
+                if operation == 28 and scf.peek() == 13:
                     _skip = scf.read(1)
-                    expr += '+{*' + read_expr(scf, 12)
+                    var.suffix = read_expr(ctx, scf, 12)
+                items.append(var)
 
             elif operation == 29:
-                func = reads_uint8(scf)
-                FUNCS = {
-                    5: 'sqr',
-                    10: 'rand',
-                    7: 'abs',
-                    0: 'sqrt',
-                    1: 'sqrt',
-                    6: 'sqrt',
-                }
-                expr += FUNCS.get(func, 'id') + '( ' + read_expr(scf, 10)
+                func = scf.u8()
+                items.append(Call(FUNCS.get(func, 'id'), read_expr(ctx, scf, 10)))
         elif operation in OPERATORS:
-            expr += ' ' + OPERATORS[operation] + ' '
+            items.append(Op(OPERATORS[operation]))
 
         elif operation == 12:
-            expr += '}'
+            items.append(Mark('}'))
             if stop != 12:
-                print('WARNING: closing paren without opening?')
+                note(ctx, 'WARNING: closing paren without opening?')
 
         elif operation == 99:
             pass
 
         else:
-            while ord(scf.read(1)) != stop:
+            while scf.u8() != stop:
                 pass
-            return expr + f'<unknown operator {operation}'
+            items.append(Mark(f'<unknown operator {operation}'))
+            return Expr(items)
             # raise ValueError(f'Unknown operator {operation}')
 
         if operation == 9:
@@ -194,167 +292,157 @@ def read_expr(scf, stop=99):
 
         if operation == stop:
             if stop != 10 or num < 0:
-                return replace_many(expr, *named_variables.items())
-                # return expr
+                return Expr(items)
 
 
-@paren
-def read_var_index(scf, arg_0=0, arg_4=0):
-    num = 0
-    expr = ''
-    pref = ''
+def read_var_index(ctx, scf, arg_0=0, arg_4=0, access='write'):
+    prefix = []
 
-    operation = ord(scf.read(1))
+    operation = scf.u8()
 
     # var_base = 0
     while operation in {14, 15}:
         if operation == 14:
-            pref += '#{:d}#'.format(read_uint16le(scf.read(2)) * 4)
+            prefix.append(Ptr(scf.u16() * 4))
 
             _skip = scf.read(2)
-            if peek_uint8(scf) == 97:
+            if scf.peek() == 97:
                 _skip = scf.read(1)
             else:
-                return expr
+                return Expr([])
 
         elif operation == 15:
-            pref += '#{:d}->'.format(read_uint16le(scf.read(2)) * 4)
+            base = scf.u16() * 4
 
-            offset1 = read_uint16le(scf.read(2))
+            offset1 = scf.u16()
 
-            dim_count = scf.read(1)[0]
+            dim_count = scf.u8()
             dim_array = scf.read(dim_count)
 
-            for i in range(dim_count):
-                pref += read_expr(scf, 12) + '->'
-
-            pref += '#'
+            dims = [read_expr(ctx, scf, 12) for i in range(dim_count)]
+            prefix.append(Ptr(base, dims))
 
-            if peek_uint8(scf) == 97:
+            if scf.peek() == 97:
                 _skip = scf.read(1)
             else:
-                return expr
+                return Expr([])
 
-        operation = scf.read(1)[0]
+        operation = scf.u8()
 
     if operation in {16, 18, 25, 28}:
-        expr = 'var8_'
+        size = 8
     elif operation in {17, 24, 27}:
-        expr = 'var16_'
+        size = 16
     elif operation in {23, 26}:
-        expr = 'var32_'
+        size = 32
+    else:
+        return Expr([Var(None, 0, prefix)])
+
+    if operation in {23, 24, 25, 26, 28}:
+        var = Var(size, scf.u16() * 4, prefix)
+    elif operation in {17, 27}:
+        var = Var(size, scf.u16() * 2, prefix)
+    else:
+        var = Var(size, scf.u16(), prefix)
+    var_ref(ctx, var, prefix, access)
 
-    expr += pref
+    if operation in {16, 26, 27, 28}:
+        var.dims = read_dims(ctx, scf)
 
-    if operation in {23, 24, 25}:
-        expr += '{}'.format(read_uint16le(scf.read(2)) * 4)
-        if operation == 25 and peek_uint8(scf) == 13:
-            _skip = scf.read(1)
-            expr += '+{*'
-            expr += read_expr(scf, 12)
-
-    elif operation == 17:
-        expr += '{}'.format(read_uint16le(scf.read(2)) * 2)
-    elif operation == 18:
-        expr += '{}'.format(read_uint16le(scf.read(2)))
-
-    elif operation in {16, 26, 27, 28}:
-        if operation == 16:
-            expr += '{}['.format(read_uint16le(scf.read(2)))
-        elif operation == 26:
-            expr += '{}['.format(read_uint16le(scf.read(2)) * 4)
-        elif operation == 27:
-            expr += '{}['.format(read_uint16le(scf.read(2)) * 2)
-        elif operation == 28:
-            expr += '{}['.format(read_uint16le(scf.read(2)) * 4)
-
-        dim_count = scf.read(1)[0]
-        arr_desc = scf.read(dim_count)
-        for dim in range(dim_count):
-            expr += read_expr(scf, 12) + ' of {:d}'.format(
-                read_uint16le(arr_desc[2 * dim : 2 * (dim + 1)])
-            )
-            if dim < dim_count - 1:
-                expr += ']['
-        expr += ']'
+    if operation in {25, 28} and scf.peek() == 13:
+        _skip = scf.read(1)
+        var.suffix = read_expr(ctx, scf, 12)
 
-        if operation == 28 and peek_uint8(scf) == 13:
-            _skip = scf.read(1)
-            expr += '+{*'
-            expr += read_expr(scf, 12)
+    return Expr([var])
 
-    else:
-        expr += 'var_0'
 
-    return replace_many(expr, *named_variables.items())
-    # return expr
+def ref(ctx, kind, name, access='read'):
+    ctx.refs.append((kind, str(name), access))
+    return name
+
+
+def var_ref(ctx, var, prefix, access='read'):
+    # variables behind a base offset prefix are indexed by their printed name,
+    # array offsets by the array base alone
+    pointer = ''.join(
+        f'#{ptr.base}#' if ptr.dims is None else f'#{ptr.base}->#' for ptr in prefix
+    )
+    ref(ctx, 'var', f'var{var.size}_{pointer}{var.offset}', access)
+    return var
+
+
+def read_var_value(ctx, scf):
+    return read_var_index(ctx, scf, access='read')
 
 
 def xparam(name, *params):
-    def inner(scf):
+    def inner(ctx, scf):
         raise NotImplementedError(name)
 
+    inner.__name__ = name
     return inner
 
 
 def gparam(name):
-    def inner(scf):
-        globals()[name](scf)
+    def inner(ctx, scf):
+        globals()[name](ctx, scf)
 
+    inner.__name__ = name
     return inner
 
 
 def fparam(name, *params):
-    def inner(scf):
-        printl(f'{name}', *(param(scf) for param in params))
+    def inner(ctx, scf):
+        printl(ctx, f'{name}', *(read_param(ctx, scf, param) for param in params))
 
+    inner.__name__ = name
     return inner
 
 
-def o1_callSub(scf):
-    offset = read_uint16le(scf.read(2))
-    printl('o1_callSub', offset)
-    ctx['functions'].append(offset)
+def o1_callSub(ctx, scf):
+    offset = ref(ctx, 'call', scf.u16())
+    printl(ctx, 'o1_callSub', offset)
 
 
-def o2_assign(scf):
-    dest_type = peek_uint8(scf)
-    var_index = read_var_index(scf)
+def o2_assign(ctx, scf):
+    dest_type = scf.peek()
+    var_index = read_var_index(ctx, scf)
 
-    if peek_uint8(scf) == 99:
+    if scf.peek() == 99:
         _skip = scf.read(1)
-        loop_count = scf.read(1)[0]
+        loop_count = scf.u8()
 
         DIVERGE_FROM_DEGOB = True
         if DIVERGE_FROM_DEGOB:
-            expr = ', '.join(read_expr(scf) for _ in range(loop_count))
-            printl("{} = [{}]".format(var_index, expr))
+            exprs = [read_expr(ctx, scf) for _ in range(loop_count)]
+            parts = [part for expr in exprs for part in (', ', expr)][1:]
+            printl(ctx, var_index, '=', Concat(['[', *parts, ']']))
         else:
             for i in range(loop_count):
-                expr = read_expr(scf)
+                expr = read_expr(ctx, scf)
                 printl(
-                    "{}[{}] = {}".format(
-                        var_index, i * 2 if dest_type == 24 else i, expr
-                    )
+                    ctx,
+                    Concat(
+                        [var_index, f'[{i * 2 if dest_type == 24 else i}] = ', expr]
+                    ),
                 )
     else:
-        expr = read_expr(scf)
-        printl("{} = {}".format(var_index, expr))
+        expr = read_expr(ctx, scf)
+        printl(ctx, var_index, '=', expr)
 
 
 def reads_uint8(stream):
     return ord(stream.read(1))
 
 
-def video_o2_loadMult(scf):
-    iid = reads_uint16le(scf)
+def video_o2_loadMult(ctx, scf):
+    iid = scf.u16()
     if iid & 0x8000:
         iid &= 0x7FFF
         _skip = scf.read(1)
 
-    data = read_ext_item(
-        ctx['ext_items'], iid - 30000, ctx['ext_data'], ctx['com_entry'] and ctx['com_data'][ctx['com_entry'].name]
-    )
+    ref(ctx, 'resource', iid)
+    data = read_ext_item(ctx, iid - 30000)
 
     with io.BytesIO(data) as stream:
         static_count = reads_uint8(stream) + 1
@@ -365,17 +453,17 @@ def video_o2_loadMult(scf):
         anim_count %= 256
 
         for i in range(static_count):
-            read_expr(scf)
-            s_size = reads_uint16le(scf)
+            read_expr(ctx, scf)
+            s_size = scf.u16()
             _skip = scf.read(s_size * 2)
-            s_size = reads_uint16le(scf)
+            s_size = scf.u16()
             _skip = scf.read(2 + s_size * 8)
 
             stream.read(14)
 
         for i in range(anim_count):
-            read_expr(scf)
-            s_size = reads_uint16le(scf)
+            read_expr(ctx, scf)
+            s_size = scf.u16()
             _skip = scf.read(2 + s_size * 8)
 
             stream.read(14)
@@ -414,32 +502,32 @@ def video_o2_loadMult(scf):
             stream.read(12 + (0 if has_imds else 24))
 
         if has_imds:
-            s_size = reads_uint16le(scf)
+            s_size = scf.u16()
             _skip = scf.read(s_size * 2)
 
-            if ctx['ver_script'] >= 51:
-                s_size = reads_uint16le(scf)
+            if ctx.ver_script >= 51:
+                s_size = scf.u16()
                 _skip = scf.read(s_size * 14)
 
     return (iid,)
 
 
-def video_o1_loadAnim(scf):
-    tmp = (read_expr(scf), reads_uint16le(scf), reads_uint16le(scf))
+def video_o1_loadAnim(ctx, scf):
+    tmp = (read_expr(ctx, scf), scf.u16(), scf.u16())
     return tmp + (scf.read(tmp[1] * 8),)
 
 
-def video_o2_loadMapObjects(scf):
-    some, iid = read_var_index(scf), reads_uint16le(scf)
+def video_o2_loadMapObjects(ctx, scf):
+    some, iid = read_var_index(ctx, scf), scf.u16()
     more = []
     if iid < 65520:
-        count = reads_uint16le(scf)
-        more = [reads_uint16le(scf) for _ in range(count)]
+        count = scf.u16()
+        more = [scf.u16() for _ in range(count)]
     return some, iid, tuple(more)
 
 
-def video_o2_loadMultObject(scf):
-    f, s, t = read_expr(scf), read_expr(scf), read_expr(scf)
+def video_o2_loadMultObject(ctx, scf):
+    f, s, t = read_expr(ctx, scf), read_expr(ctx, scf), read_expr(ctx, scf)
 
     options = (
         'animation',
@@ -454,77 +542,81 @@ def video_o2_loadMultObject(scf):
         'newLayer',
         'newAnimation',
     )
-    r = dict(zip(options, (read_expr(scf) for _ in options)))
+    r = dict(zip(options, (read_expr(ctx, scf) for _ in options)))
     return f, s, t, r
 
 
-def video_o2_totSub(scf):
-    length = reads_uint8(scf)
-    args = read_expr(scf) if length & 0x80 else scf.read(length)
-    return args, reads_uint8(scf)
+def video_o2_totSub(ctx, scf):
+    length = scf.u8()
+    args = read_expr(ctx, scf) if length & 0x80 else scf.read(length)
+    return args, scf.u8()
 
 
-def video_o1_loadStatic(scf):
-    expr = read_expr(scf)
-    s_size1 = reads_uint16le(scf)
+def video_o1_loadStatic(ctx, scf):
+    expr = read_expr(ctx, scf)
+    s_size1 = scf.u16()
     _skip = scf.read(s_size1 * 2)
-    s_size2 = reads_uint16le(scf)
-    num = reads_uint16le(scf)
+    s_size2 = scf.u16()
+    num = scf.u16()
     _skip = scf.read(s_size2 * 8)
 
     return expr, s_size1, s_size2, num
 
 
-def video_o2_pushVars(scf):
-    count = reads_uint8(scf)
+def video_o2_pushVars(ctx, scf):
+    count = scf.u8()
     params = []
 
     for i in range(count):
-        if peek_uint8(scf) in {25, 28}:
-            params.append((read_var_index(scf), 'animDataSize'))
+        if scf.peek() in {25, 28}:
+            params.append((read_var_value(ctx, scf), 'animDataSize'))
             _skip = scf.read(1)
         else:
-            params.append((read_expr(scf), 4))
+            params.append((read_expr(ctx, scf), 4))
 
     return params
 
 
-def video_o2_popVars(scf):
-    count = reads_uint8(scf)
-    params = [read_var_index(scf) for _ in range(count)]
+def video_o2_popVars(ctx, scf):
+    count = scf.u8()
+    params = [read_var_index(ctx, scf) for _ in range(count)]
     return params
 
 
-def video_o2_playMult(scf):
-    mult_data = reads_uint16le(scf)
+def video_o2_playMult(ctx, scf):
+    mult_data = scf.u16()
     return mult_data >> 1, mult_data & 1
 
 
 def vparam(name, *params):
-    def inner(scf):
-        printl(f'(D) {name}', *(param(scf) for param in params))
+    def inner(ctx, scf):
+        printl(ctx, f'(D) {name}', *(read_param(ctx, scf, param) for param in params))
 
+    inner.__name__ = name
     return inner
 
 
 def lvparam(name, lfunc):
-    def inner(scf):
-        printl(f'(D) {name}', *lfunc(scf))
+    def inner(ctx, scf):
+        printl(ctx, f'(D) {name}', *lfunc(ctx, scf))
 
+    inner.__name__ = name
     return inner
 
 
 def cparam(name, *params):
-    def inner(scf):
-        printl(f'(G) {name}', *(param(scf) for param in params))
+    def inner(ctx, scf):
+        printl(ctx, f'(G) {name}', *(read_param(ctx, scf, param) for param in params))
 
+    inner.__name__ = name
     return inner
 
 
 def lcparam(name, lfunc):
-    def inner(scf):
-        printl(f'(G) {name}', *lfunc(scf))
+    def inner(ctx, scf):
+        printl(ctx, f'(G) {name}', *lfunc(ctx, scf))
 
+    inner.__name__ = name
     return inner
 
 
@@ -625,12 +717,9 @@ video_ops = {
 }
 
 
-def o1_drawOperations(scf):
-    vop = ord(scf.read(1))
-    vfunc = video_ops.get(vop)
-    if vfunc is None:
-        raise ValueError(f'Missing video op {hex(vop)} = {vop}')
-    vfunc(scf)
+def o1_drawOperations(ctx, scf):
+    vop = scf.u8()
+    dispatch(ctx, scf, 'video', video_ops, vop)
 
 
 goblin_lookup = {
@@ -713,18 +802,18 @@ goblin_lookup = {
 }
 
 
-def gob_o2_handleGoblins(scf):
-    return [f'var32_{reads_uint16le(scf) * 4}' for _ in range(6)]
+def gob_o2_handleGoblins(ctx, scf):
+    return [Var(32, scf.u16() * 4) for _ in range(6)]
 
 
-def gob_o1_dummy(scf):
+def gob_o1_dummy(ctx, scf):
     scf.seek(-2, io.SEEK_CUR)
-    skip = read_uint16le(scf.read(2))
+    skip = scf.u16()
     return list(scf.read(skip * 2))
 
 
-def gob_o2_infogrames(scf):
-    return [f'var8_{reads_uint16le(scf) * 4}']
+def gob_o2_infogrames(ctx, scf):
+    return [Var(8, scf.u16() * 4)]
 
 goblin_ops = {
     0x00: lcparam('o2_loadInfogramesIns', gob_o2_infogrames),
@@ -738,137 +827,147 @@ goblin_ops = {
     3000: cparam('o_weenNOP_3000'),
 }
 
+o2_goblin_ops = {
+    cmd: goblin_ops[index] for cmd, index in goblin_lookup.items() if index in goblin_ops
+}
 
-def o2_goblinFunc(scf):
-    cmd = reads_uint16le(scf)
+
+def o2_goblinFunc(ctx, scf):
+    cmd = scf.u16()
     _skip = scf.read(2)
 
     if cmd != 101:
-        gfunc = goblin_ops.get(goblin_lookup[cmd])
-        if gfunc is None:
-            raise ValueError(f'Missing goblin op {hex(cmd)} = {cmd}')
-        gfunc(scf)
+        dispatch(ctx, scf, 'goblin', o2_goblin_ops, cmd)
 
 
-def o1_loadTot(scf):
-    size = reads_uint8(scf)
+def o1_loadTot(ctx, scf):
+    size = scf.u8()
 
-    fname = scf.read(size).decode('ascii') if size & 0x80 == 0 else read_expr(scf)
-    printl('o1_loadTot', fname)
+    if size & 0x80 == 0:
+        fname = ref(ctx, 'tot', scf.read(size).decode('ascii'))
+    else:
+        fname = read_expr(ctx, scf)
+    printl(ctx, 'o1_loadTot', fname)
 
 
-def o2_loadSound(scf):
-    slot = read_expr(scf)
-    id = read_uint16le(scf.read(2))
+def o2_loadSound(ctx, scf):
+    slot = read_expr(ctx, scf)
+    id = scf.u16()
     if id == 65535:
         msg = scf.read(9).decode('ascii')
-        printl('o2_loadSound', slot, msg.split('\0'))
+        ref(ctx, 'sound', msg.split('\0')[0])
+        printl(ctx, 'o2_loadSound', slot, msg.split('\0'))
     else:
-        printl('o2_loadSound', slot, id)
+        printl(ctx, 'o2_loadSound', slot, ref(ctx, 'sound', id))
 
 
-def o1_repeatUntil(scf):
-    printl('repeat {')
-    func_block(scf, 1)
+def o1_repeatUntil(ctx, scf):
+    printl(ctx, 'repeat {')
+    func_block(ctx, scf, 1)
     scf.read(1)
-    cond = read_expr(scf)
-    printl(f'}} until ({cond})')
+    cond = read_expr(ctx, scf)
+    printl(ctx, Concat(['} until (', cond, ')']))
 
 
-def o1_whileDo(scf):
-    printl("while ({}) {{".format(read_expr(scf)))
-    func_block(scf, 1)
-    printl('}')
+def o1_whileDo(ctx, scf):
+    printl(ctx, Concat(['while (', read_expr(ctx, scf), ') {']))
+    func_block(ctx, scf, 1)
+    printl(ctx, '}')
 
 
-def o1_loadSpriteToPos(scf):
+def o1_loadSpriteToPos(ctx, scf):
     printl(
+        ctx,
         'o1_loadSpriteToPos',
-        reads_uint16le(scf),
-        read_expr(scf),
-        read_expr(scf),
-        reads_uint8(scf),
+        ref(ctx, 'resource', scf.u16()),
+        read_expr(ctx, scf),
+        read_expr(ctx, scf),
+        scf.u8(),
     )
     _skip = scf.read(1)
 
 
-def o1_palLoad(scf):
-    sub = ord(scf.read(1))
+def o1_palLoad(ctx, scf):
+    sub = scf.u8()
     masked = sub & 0x7F
-    printl('o1_palLoad', int(sub & 0x80 != 0), masked)
+    printl(ctx, 'o1_palLoad', int(sub & 0x80 != 0), masked)
 
     skip_count = {48: 48, 49: 18, 50: 16, 51: 2, 52: 48, 53: 2, 55: 2, 54: 0, 61: 4}
 
     _skip = scf.read(skip_count[masked])
 
 
-def o1_if(scf):
-    printl("if ({}) {{".format(read_expr(scf)))
+def o1_if(ctx, scf):
+    printl(ctx, Concat(['if (', read_expr(ctx, scf), ') {']))
 
-    func_block(scf, 0)
+    func_block(ctx, scf, 0)
 
-    if (scf.read(1)[0] >> 4) == 12:
-        printl('} else {')
-        func_block(scf, 0)
+    if (scf.u8() >> 4) == 12:
+        printl(ctx, '} else {')
+        func_block(ctx, scf, 0)
 
-    printl('}')
+    printl(ctx, '}')
 
 
-def o1_switch(scf):
-    printl("switch ({}) {{".format(read_var_index(scf)))
+def o1_switch(ctx, scf):
+    printl(ctx, Concat(['switch (', read_var_value(ctx, scf), ') {']))
 
     while True:
-        ln = reads_uint8(scf)
+        ln = scf.u8()
         if ln == 251:
             break
 
         for _ in range(ln):
-            printl('case {}:'.format(read_expr(scf)))
+            printl(ctx, Concat(['case ', read_expr(ctx, scf), ':']))
 
-        func_block(scf, 0)
+        func_block(ctx, scf, 0)
 
-        printl(' ' * 4 + 'break')
+        printl(ctx, ' ' * 4 + 'break')
 
-    if (peek_uint8(scf) >> 4) == 4:
-        printl('default:')
+    if (scf.peek() >> 4) == 4:
+        printl(ctx, 'default:')
         _skip = scf.read(1)
-        func_block(scf, 0)
+        func_block(ctx, scf, 0)
 
-        printl(' ' * 4 + 'break')
+        printl(ctx, ' ' * 4 + 'break')
 
-    printl('}')
+    printl(ctx, '}')
 
 
-def o2_printText(scf):
+def o2_printText(ctx, scf):
     params = (
-        read_expr(scf),
-        read_expr(scf),
-        read_expr(scf),
-        read_expr(scf),
-        read_expr(scf),
+        read_expr(ctx, scf),
+        read_expr(ctx, scf),
+        read_expr(ctx, scf),
+        read_expr(ctx, scf),
+        read_expr(ctx, scf),
     )
 
+    parts = [params[0]]
+    for param in params[1:]:
+        parts += [' ', param]
     expr = ' "'
     while True:
-        while peek_uint8(scf) != ord('.') and peek_uint8(scf) != 200:
+        while scf.peek() != ord('.') and scf.peek() != 200:
             expr += scf.read(1).decode('cp437')  # should be `SELECCCIóN DEL TIPO` in Ween english demo - REGLAGE.TOT
 
-        if peek_uint8(scf) != 200:
+        if scf.peek() != 200:
             scf.read(1)
 
             expr += '" '
-            if peek_uint8(scf) in {16, 17, 18, 23, 24, 25, 26, 27, 28}:
-                expr += read_var_index(scf)
+            if scf.peek() in {16, 17, 18, 23, 24, 25, 26, 27, 28}:
+                parts += [expr, read_var_value(ctx, scf)]
+                expr = ''
             scf.read(1)
         else:
             expr += '"'
 
-        if peek_uint8(scf) == 200:
+        if scf.peek() == 200:
             break
 
     scf.read(1)
 
-    printl('o2_printText', ' '.join(str(x) for x in params) + expr)
+    printl(ctx, 'o2_printText', Concat(parts + [expr]))
 
 
 def read_block(scf):
@@ -880,99 +979,117 @@ def read_block(scf):
     return something + size + skipped
 
 
-def evaluate_new(scf):
-    typ = scf.read(1)[0]
-    print('TYP', typ)
+def evaluate_new(ctx, scf):
+    typ = scf.u8()
+    note(ctx, 'TYP', typ)
     if typ & 0x40:
         typ -= 0x40
-        num = scf.read(1)[0]
+        num = scf.u8()
     if typ & 0x80:
-        left = read_expr(scf)
-        top = read_expr(scf)
-        width = read_expr(scf)
-        height = read_expr(scf)
+        left = read_expr(ctx, scf)
+        top = read_expr(ctx, scf)
+        width = read_expr(ctx, scf)
+        height = read_expr(ctx, scf)
     else:
-        left = reads_uint16le(scf)
-        top = reads_uint16le(scf)
-        width = reads_uint16le(scf)
-        height = reads_uint16le(scf)
+        left = scf.u16()
+        top = scf.u16()
+        width = scf.u16()
+        height = scf.u16()
     typ &= 0x7F
-    print('HOTSPOT', typ, left, top, width, height)
+    note(ctx, 'HOTSPOT', typ, left, top, width, height)
     if typ in {11, 12}:
         _skip = scf.read(6)
-        func_block(scf, 2)
+        func_block(ctx, scf, 2)
         # _skipped = read_block(scf)
     elif typ in {0, 1}:
         _skip = scf.read(6)
-        func_block(scf, 2)
-        func_block(scf, 2)
+        func_block(ctx, scf, 2)
+        func_block(ctx, scf, 2)
         # _skipped = read_block(scf)
         # _skipped2 = read_block(scf)
     elif typ in {3, 4, 5, 6, 7, 8, 9, 10}:
-        key = read_var_index(scf)
-        font_index = reads_uint16le(scf)
+        key = read_var_index(ctx, scf)
+        font_index = scf.u16()
         back_color, front_color = scf.read(2)
         if 5 <= typ <= 8:
-            ln = reads_uint16le(scf)
-            # func_block(scf, 2)
+            ln = scf.u16()
+            # func_block(ctx, scf, 2)
             _skipped = scf.read(ln)
         if typ & 1 == 0:
-            func_block(scf, 2)
+            func_block(ctx, scf, 2)
             # _skipped = read_block(scf)
     elif typ in {20, 2, 21}:
-        key = reads_uint16le(scf)
-        ids = reads_uint16le(scf)
-        flags = reads_uint16le(scf)
-        func_block(scf, 2)
+        key = scf.u16()
+        ids = scf.u16()
+        flags = scf.u16()
+        func_block(ctx, scf, 2)
         # _skipped = read_block(scf)
         # print(scf.tell(), _skipped)
 
 
-def func_block(scf, ret_flag):
+def func_block(ctx, scf, ret_flag):
     # print('ENTER', scf, scf.tell(), ret_flag)
 
     block_start = scf.tell()
 
-    if scf.read(1) == b'':
-        print('WARNING: EOF')
+    if scf.tell() >= len(scf):
+        note(ctx, 'WARNING: EOF')
+        return
+
+    if scf.peek() != 1 or block_start + 4 > len(scf):
+        block_body(ctx, scf, ret_flag)
+        return
+
+    # sized blocks are queued and decoded on their own, hotspots have no size
+    _block_type = scf.u8()
+    cmd_count = scf.u8()
+    size = scf.u16()
+    if cmd_count == 0:
+        ctx.offset = scf.tell()
         return
-    scf.seek(-1, 1)
+    end = block_start + size + 2
+    if end > len(scf):
+        raise ValueError(f'Block at {block_start + 128} ends past the script')
+    ctx.block.successors.append((len(ctx.ir), ctx.indent, block_start))
+    if block_start not in ctx.blocks:
+        ctx.worklist.append((block_start, ret_flag))
+    scf.seek(end)
+    ctx.offset = end
+
 
-    block_type = scf.read(1)[0]
-    cmd_count = scf.read(1)[0]
+def block_body(ctx, scf, ret_flag):
+    block_type = scf.u8()
+    cmd_count = scf.u8()
 
     if block_type == 2:
-        ctx['indent'] += 1
-        printl('hotspot {')
+        ctx.indent += 1
+        printl(ctx, 'hotspot {')
         handle_mouse, duration, leave_window, idx1, idx2, recalculate = scf.read(6)
-        print(cmd_count)
+        note(ctx, cmd_count)
         for i in range(cmd_count):
-            evaluate_new(scf)
+            evaluate_new(ctx, scf)
         # print(scf.read(1))
 
-        ctx['indent'] -= 1
+        ctx.indent -= 1
         return
 
     assert block_type == 1, block_type
-    size = reads_uint16le(scf)
+    size = scf.u16()
 
     if cmd_count == 0:
         return
     assert cmd_count > 0
 
+    block_start = scf.tell() - 4
+    ctx.cmd_count = cmd_count
+    ctx.counter = 0
+    ctx.ret_flag = ret_flag
+    ctx.indent += 1
 
-    last_level = ctx.get('counter', 0)
-    last_cmd_count = ctx.get('cmd_count', 0)
-
-    ctx['cmd_count'] = cmd_count
-    ctx['counter'] = 0
-    ctx['ret_flag'] = ret_flag
-    ctx['indent'] += 1
-
-    while ctx['counter'] < ctx['cmd_count']:
+    while ctx.counter < ctx.cmd_count:
         # print('LOOP', scf, scf.tell(), ret_flag)
 
-        cmd_t = reads_uint8(scf)
+        cmd_t = scf.u8()
         cmd = cmd_t
 
         if (cmd >> 4) >= 12:
@@ -981,7 +1098,7 @@ def func_block(scf, ret_flag):
         else:
             cmd2 = 0
 
-        ctx['counter'] += 1
+        ctx.counter += 1
 
         if cmd2 == 0:
             cmd >>= 4
@@ -992,7 +1109,7 @@ def func_block(scf, ret_flag):
         # begin = scf.tell()
         # print('BEGIN', begin + 128)
 
-        opcode(scf, cmd_u)
+        opcode(ctx, scf, cmd_u)
 
         # end = scf.tell()
         # scf.seek(begin)
@@ -1003,72 +1120,78 @@ def func_block(scf, ret_flag):
     if left != 0:
         if left > 0:
             _skip = scf.read(left)
-            print('WARNING: Skipped', _skip)
+            note(ctx, 'WARNING: Skipped', _skip)
         else:
             raise ValueError('Block size mismatch: {} != {}', scf.tell() - block_start, size + 2)
-    ctx['indent'] -= 1
-    ctx['counter'] = last_level
-    ctx['cmd_count'] = last_cmd_count
+    ctx.indent -= 1
 
 
 def text_hint(ctx, textid):
-    res = ctx['texts'][textid]
-    lang = ctx.get('lang')
+    res = ctx.texts[textid]
+    lang = ctx.lang
     if lang is not None:
         return res[lang]
     return res
 
 
-def o1_printTotText(scf):
-    textid = reads_uint16le(scf)
-    printl('o1_printTotText', textid, '//', text_hint(ctx, textid))
+def o1_printTotText(ctx, scf):
+    textid = ref(ctx, 'text', scf.u16())
+    printl(ctx, 'o1_printTotText', textid, '//', text_hint(ctx, textid))
 
 
-def o2_getTotTextItemPart(scf):
-    textid = reads_uint16le(scf)
-    var_string = read_var_index(scf)
-    part = read_expr(scf)
-    printl(f'{var_string} = o2_getTotTextItemPart', textid, part, '//', text_hint(ctx, textid))
+def o2_getTotTextItemPart(ctx, scf):
+    textid = ref(ctx, 'text', scf.u16())
+    var_string = read_var_index(ctx, scf)
+    part = read_expr(ctx, scf)
+    printl(
+        ctx,
+        Concat([var_string, ' = o2_getTotTextItemPart']),
+        textid,
+        part,
+        '//',
+        text_hint(ctx, textid),
+    )
 
 
-def o1_assign(scf):
-    printl('{} = {}'.format(read_var_index(scf), read_expr(scf)))
+def o1_assign(ctx, scf):
+    printl(ctx, read_var_index(ctx, scf), '=', read_expr(ctx, scf))
 
 
-def o1_setcmdCount(scf):
-    ctx['cmd_count'] = reads_uint8(scf)
-    ctx['counter'] = 0
-    printl('o1_setcmdCount', ctx['cmd_count'])
+def o1_setcmdCount(ctx, scf):
+    ctx.cmd_count = scf.u8()
+    ctx.counter = 0
+    printl(ctx, 'o1_setcmdCount', ctx.cmd_count)
 
-def o1_loadSound(scf):
-    slot = read_expr(scf)
-    id = reads_uint16le(scf)
+def o1_loadSound(ctx, scf):
+    slot = read_expr(ctx, scf)
+    id = scf.u16()
     if id == 0xFFFF:
         msg = scf.read(9).decode('ascii')
-        printl('o1_loadSound', slot,id, msg.split('\0'))
+        ref(ctx, 'sound', msg.split('\0')[0])
+        printl(ctx, 'o1_loadSound', slot,id, msg.split('\0'))
     else:
-        printl('o1_loadSound', slot, id)
+        printl(ctx, 'o1_loadSound', slot, ref(ctx, 'sound', id))
 
 
-def o1_printText(scf):
-    params = [read_expr(scf) for _ in range(5)]
-    while peek_uint8(scf) != 200:
+def o1_printText(ctx, scf):
+    params = [read_expr(ctx, scf) for _ in range(5)]
+    while scf.peek() != 200:
         expr = '"'
-        while peek_uint8(scf) != ord('.') and peek_uint8(scf) != 200:
+        while scf.peek() != ord('.') and scf.peek() != 200:
             expr += scf.read(1).decode('cp437')
         
-        if peek_uint8(scf) != 200:
+        if scf.peek() != 200:
             _skip = scf.read(1)
             expr += '" '
-            if peek_uint8(scf) in {16, 17, 18, 23, 24, 25, 26, 27, 28}:
-                expr += read_var_index(scf)
+            if scf.peek() in {16, 17, 18, 23, 24, 25, 26, 27, 28}:
+                expr = Concat([expr, read_var_value(ctx, scf)])
             scf.read(1)
         else:
             expr += '"'
         params.append(expr)
     _skip = scf.read(1)
 
-    printl('o1_printText', *params)
+    printl(ctx, 'o1_printText', *params)
 
 goblin1_ops = {
     # 0: cparam('o1_UNKNOW', reads_uint16le, reads_uint16le, reads_uint16le),
@@ -1115,53 +1238,47 @@ geisha_ops = {
 }
 
 
-def o1_goblinFunc(scf):
+def o1_goblinFunc(ctx, scf):
     gobParams = {}
     gobParams['extraData'] = 0
     gobParams['objIndex'] = -1
 
-    cmd = reads_uint16le(scf)
+    cmd = scf.u16()
     _skip = scf.read(2)
 
     if 0 < cmd < 17:
-        gobParams['objIndex'] = reads_uint16le(scf)
-        gobParams['extraData'] = reads_uint16le(scf)
+        gobParams['objIndex'] = scf.u16()
+        gobParams['extraData'] = scf.u16()
     if 90 < cmd < 107:
-        gobParams['objIndex'] = reads_uint16le(scf)
-        gobParams['extraData'] = reads_uint16le(scf)
+        gobParams['objIndex'] = scf.u16()
+        gobParams['extraData'] = scf.u16()
         cmd -= 90
     if 110 < cmd < 128:
-        gobParams['objIndex'] = reads_uint16le(scf)
+        gobParams['objIndex'] = scf.u16()
         cmd -= 90
     elif 20 < cmd < 38:
-        gobParams['objIndex'] = reads_uint16le(scf)
+        gobParams['objIndex'] = scf.u16()
 
     if cmd < 40 and gobParams['objIndex'] == -1:
-        printl('o1_goblinFunc', cmd)
+        printl(ctx, 'o1_goblinFunc', cmd)
         return
 
     # TODO: print function name
-    gfunc = goblin1_ops.get(cmd)
-    if gfunc is None:
-        raise ValueError(f'Missing goblin op {hex(cmd)} = {cmd}')
-    gfunc(scf)
+    dispatch(ctx, scf, 'goblin', goblin1_ops, cmd)
 
 
-def o5_istrlen(scf):
-    if peek_uint8(scf) == 0x80:
+def o5_istrlen(ctx, scf):
+    if scf.peek() == 0x80:
         _skip = scf.read(1)
-    printl('o5_istrlen', read_var_index(scf), read_var_index(scf))
+    printl(ctx, 'o5_istrlen', read_var_value(ctx, scf), read_var_index(ctx, scf))
 
 
-def oGeisha_goblinFunc(scf):
+def oGeisha_goblinFunc(ctx, scf):
     
-    cmd = reads_uint16le(scf)
+    cmd = scf.u16()
     _skip = scf.read(2)
 
-    gfunc = geisha_ops.get(cmd)
-    if gfunc is None:
-        raise ValueError(f'Missing goblin op {hex(cmd)} = {cmd}')
-    gfunc(scf)
+    dispatch(ctx, scf, 'geisha', geisha_ops, cmd)
 
 
 
@@ -1233,7 +1350,7 @@ gob1_ops = { # version 49 - Gob1, Bargon, Fascination, LittleRed
         read_expr,
         read_expr,
     ),
-    0x35: fparam('o1_strToLong', read_var_index, read_var_index),
+    0x35: fparam('o1_strToLong', read_var_value, read_var_index),
     0x36: xparam('o1_invalidate'),
     0x37: fparam('o1_setBackDelta', read_expr, read_expr),
     0x38: fparam('o1_playSound', read_expr, read_expr, read_expr),
@@ -1241,14 +1358,14 @@ gob1_ops = { # version 49 - Gob1, Bargon, Fascination, LittleRed
     0x3A: gparam('o1_loadSound'),
     0x3B: fparam('o1_freeSoundSlot', read_expr),
     0x3C: fparam('o1_waitEndPlay'),
-    0x3D: fparam('o1_playComposition', read_var_index, read_expr), # check diff in little red
+    0x3D: fparam('o1_playComposition', read_var_value, read_expr), # check diff in little red
     0x3E: fparam('o1_getFreeMem', read_var_index, read_var_index),
     0x3F: fparam('o1_checkData', read_expr, read_var_index),
     0x41: xparam('o1_cleanupStr', read_var_index),
     0x42: fparam('o1_insertStr', read_var_index, read_expr),
     0x43: xparam('o1_cutStr', read_var_index, read_expr, read_expr),
     0x44: xparam('o1_strstr', read_var_index, read_expr, read_var_index),
-    0x45: fparam('o1_istrlen', read_var_index, read_var_index),
+    0x45: fparam('o1_istrlen', read_var_value, read_var_index),
     0x46: fparam('o1_setMousePos', read_expr, read_expr),
     0x47: fparam('o1_setFrameRate', read_expr),
     0x48: fparam('o1_animatePalette'),
@@ -1257,7 +1374,7 @@ gob1_ops = { # version 49 - Gob1, Bargon, Fascination, LittleRed
     0x4B: fparam('o1_loadFont', read_expr, reads_uint16le),
     0x4C: fparam('o1_freeFont', reads_uint16le),
     0x4D: fparam('o1_readData', read_expr, read_var_index, read_expr, read_expr),
-    0x4E: fparam('o1_writeData', read_expr, read_var_index, read_expr, read_expr),
+    0x4E: fparam('o1_writeData', read_expr, read_var_value, read_expr, read_expr),
     0x4F: fparam('o1_manageDataFile', read_expr),
 }
 
@@ -1270,7 +1387,7 @@ gobGeisha_ops = { # version 48 - Geisha
     0x3A: fparam('oGeisha_loadSound', read_expr, read_expr),
     # 0x3F: fparam('oGeisha_checkData', read_expr, read_var_index),
     0x4D: fparam('oGeisha_readData', read_expr, read_var_index),
-    0x4E: fparam('oGeisha_writeData', read_expr, read_var_index),
+    0x4E: fparam('oGeisha_writeData', read_expr, read_var_value),
 }
 
 
@@ -1288,7 +1405,7 @@ gob2_ops = { # Version 50 - Gob2, Ween
     0x3E: fparam('o2_getFreeMem', read_var_index, read_var_index),
     0x3F: fparam('o2_checkData', read_expr, read_var_index),
     0x4D: fparam('o2_readData', read_expr, read_var_index, read_expr, read_expr),
-    0x4E: fparam('o2_writeData', read_expr, read_var_index, read_expr, read_expr),
+    0x4E: fparam('o2_writeData', read_expr, read_var_value, read_expr, read_expr),
 }
 
 
@@ -1332,52 +1449,311 @@ named_variables = {
 }
 
 
-def opcode(scf, cmd):
-    ctx['offset'] = scf.tell()
-    func = ctx['optable'][cmd]
-    # print(cmd, hex(cmd), func)
-    func(scf)
-    ctx['offset'] = scf.tell()
+def dispatch(ctx, scf, kind, table, cmd):
+    func = table.get(cmd)
+    stats = ctx.stats
+    if func is None:
+        if stats is not None:
+            stats.missing.setdefault((kind, cmd), []).append(128 + ctx.offset)
+        raise ValueError(f'Missing {kind} op {hex(cmd)} = {cmd}')
+    if stats is None:
+        func(ctx, scf)
+        return
+    stats.nested.append(0.0)
+    start = time.perf_counter()
+    try:
+        func(ctx, scf)
+    finally:
+        elapsed = time.perf_counter() - start
+        # time spent in nested blocks is accounted to their own opcodes
+        own = elapsed - stats.nested.pop()
+        if stats.nested:
+            stats.nested[-1] += elapsed
+        stats.counts[kind, cmd] += 1
+        stats.times[kind, cmd] += own
+        stats.names[kind, cmd] = func.__name__
+
+
+def opcode(ctx, scf, cmd):
+    last_opcode = ctx.opcode
+    ctx.offset = scf.tell()
+    ctx.opcode = cmd
+    dispatch(ctx, scf, 'script', ctx.optable, cmd)
+    ctx.offset = scf.tell()
+    ctx.opcode = last_opcode
+
+
+@dataclass
+class OpcodeStats:
+    # calls, own time and unknown opcode offsets per (table, opcode)
+    counts: Counter = field(default_factory=Counter)
+    times: Counter = field(default_factory=Counter)
+    names: dict[tuple[str, int], str] = field(default_factory=dict)
+    missing: dict[tuple[str, int], list] = field(default_factory=dict)
+    nested: list[float] = field(default_factory=list)
+
+    def update(self, other, script):
+        self.counts.update(other.counts)
+        self.times.update(other.times)
+        self.names.update(other.names)
+        for key, offsets in other.missing.items():
+            self.missing.setdefault(key, []).extend(
+                f'{script}:{offset}' for offset in offsets
+            )
 
 
-ctx = {
-    'offset': 0,
-    'indent': 0,
+def print_stats(stats, width=40):
+    total = sum(stats.times.values()) or 1
+    most = max(stats.counts.values(), default=1)
+    for (kind, cmd), count in stats.counts.most_common():
+        spent = stats.times[kind, cmd]
+        bar = '#' * max(1, round(width * count / most))
+        print(
+            f'{kind:6} {cmd:#06x} {stats.names[kind, cmd]:32} {count:8d}'
+            f' {1000 * spent:10.2f}ms {100 * spent / total:5.1f}% {bar}'
+        )
+    for (kind, cmd), offsets in sorted(stats.missing.items()):
+        print(f'missing {kind} {cmd:#06x} at', ', '.join(map(str, offsets)))
+
+
+@dataclass
+class Instruction:
+    # one decompiled line, `offset` is None for diagnostics outside the script
+    offset: int | None
+    depth: int
+    opcode: int | None
+    args: list
+    refs: list = field(default_factory=list)
+
+
+@dataclass
+class Block:
+    # a run of commands decoded once, nested blocks are decoded on their own
+    start: int
+    end: int
+    instructions: list[Instruction] = field(default_factory=list)
+    # nested blocks in place of their body: (instruction index, depth, start)
+    successors: list[tuple[int, int, int]] = field(default_factory=list)
+
+
+@dataclass
+class DecompilerContext:
+    # state of a single script being decompiled, output goes to `ir`
+    optable: dict[int, Callable]
+    ir: list[Instruction] = field(default_factory=list)
+    texts: dict[int, dict[str, str]] = field(default_factory=dict)
+    ext: ResourceTable | None = None
+    ver_script: int = 0
+    lang: str | None = None
+    functions: list[int] = field(default_factory=list)
+    blocks: dict[int, Block] = field(default_factory=dict)
+    block: Block | None = None
+    # (start, ret_flag) of queued blocks
+    worklist: list[tuple[int, int]] = field(default_factory=list)
+    stats: OpcodeStats | None = None
+    failures: list[dict] = field(default_factory=list)
+    refs: list[tuple[str, str, str]] = field(default_factory=list)
+    offset: int = 0
+    indent: int = 0
+    opcode: int | None = None
+    counter: int = 0
+    cmd_count: int = 0
+    ret_flag: int = 0
+
+
+def printl(ctx, *msgs):
+    # operands stay nodes until format_text renders them
+    # and references decoded since the previous line belong to this one
+    refs, ctx.refs = ctx.refs, []
+    args = list(msgs)
+    ctx.ir.append(Instruction(128 + ctx.offset, ctx.indent, ctx.opcode, args, refs))
+
+
+def note(ctx, *msgs):
+    refs, ctx.refs = ctx.refs, []
+    args = list(msgs)
+    ctx.ir.append(Instruction(None, ctx.indent, ctx.opcode, args, refs))
+
+
+NODE_TYPES = (Const, Str, Op, Mark, Ptr, Var, Call, Expr, Concat)
+NODE_TAGS = {node_type.__name__.lower(): node_type for node_type in NODE_TYPES}
+
+
+def format_var(var):
+    pointer = ''.join(map(format_node, var.prefix))
+    if var.size is None:
+        text = f'{pointer}var_0'
+    else:
+        text = f'var{var.size}_{pointer}{var.offset}'
+    text = named_variables.get(text, text)
+    if var.dims is not None:
+        dims = ']['.join(
+            f'{format_node(expr)} of {bound:d}' for expr, bound in var.dims
+        )
+        text += f'[{dims}]'
+    if var.address:
+        text = f'(&{text})'
+    if var.suffix is not None:
+        text += '+{*' + format_node(var.suffix)
+    return text
+
+
+def format_node(node):
+    if isinstance(node, Expr):
+        text = ''.join(map(format_node, node.items))
+        # nested expressions are grouped once they span several tokens
+        return f'({text})' if ' ' in text else text
+    if isinstance(node, Var):
+        return format_var(node)
+    if isinstance(node, Const):
+        return f'{node.value:d}'
+    if isinstance(node, Str):
+        return f'"{node.value}"'
+    if isinstance(node, Op):
+        return f' {node.symbol} '
+    if isinstance(node, Mark):
+        return node.text
+    if isinstance(node, Ptr):
+        if node.dims is None:
+            return f'#{node.base:d}#'
+        dims = ''.join(f'{format_node(dim)}->' for dim in node.dims)
+        return f'#{node.base:d}->{dims}#'
+    if isinstance(node, Call):
+        return f'{node.func}( ' + format_node(node.args)
+    if isinstance(node, Concat):
+        return ''.join(map(format_arg, node.parts))
+    raise TypeError(f'not an expression node: {node!r}')
+
+
+def format_repr(arg):
+    if isinstance(arg, NODE_TYPES):
+        return repr(format_node(arg))
+    if isinstance(arg, tuple):
+        items = [format_repr(item) for item in arg]
+        return '(' + ', '.join(items) + (',' if len(items) == 1 else '') + ')'
+    if isinstance(arg, list):
+        return '[' + ', '.join(map(format_repr, arg)) + ']'
+    if isinstance(arg, dict):
+        items = (
+            f'{format_repr(key)}: {format_repr(value)}' for key, value in arg.items()
+        )
+        return '{' + ', '.join(items) + '}'
+    return repr(arg)
+
+
+def format_arg(arg):
+    # operands print as str() would, with nodes rendered as source text
+    if isinstance(arg, NODE_TYPES):
+        return format_node(arg)
+    if isinstance(arg, (tuple, list, dict)):
+        return format_repr(arg)
+    return str(arg)
+
+
+def encode_arg(arg):
+    # tag what json cannot hold so read_ir restores the same operands
+    if isinstance(arg, NODE_TYPES):
+        values = {f.name: encode_arg(getattr(arg, f.name)) for f in fields(arg)}
+        return {'$': type(arg).__name__.lower(), **values}
+    if isinstance(arg, tuple):
+        return {'$': 'tuple', 'items': [encode_arg(item) for item in arg]}
+    if isinstance(arg, bytes):
+        return {'$': 'bytes', 'hex': arg.hex()}
+    if isinstance(arg, dict):
+        items = [[encode_arg(key), encode_arg(value)] for key, value in arg.items()]
+        return {'$': 'dict', 'items': items}
+    if isinstance(arg, list):
+        return [encode_arg(item) for item in arg]
+    return arg
+
+
+def decode_arg(arg):
+    if isinstance(arg, list):
+        return [decode_arg(item) for item in arg]
+    if not isinstance(arg, dict):
+        return arg
+    tag = arg['$']
+    if tag == 'tuple':
+        return tuple(decode_arg(item) for item in arg['items'])
+    if tag == 'bytes':
+        return bytes.fromhex(arg['hex'])
+    if tag == 'dict':
+        return {decode_arg(key): decode_arg(value) for key, value in arg['items']}
+    values = {name: decode_arg(value) for name, value in arg.items() if name != '$'}
+    return NODE_TAGS[tag](**values)
+
+
+# format -> (offset prefix, indent width)
+TEXT_FORMATS = {
+    'offsets': ('[{:08d}]:', 4),
+    'compact': ('{:x}:', 2),
+    'plain': (None, 4),
 }
 
 
-def printl(*msgs):
-    offset = ctx['offset']
-    indent = ctx['indent']
-    indent = ' ' * 4 * indent
-    pref = ''
-    pref = f'[{128 + offset:08d}]:'
-    print(pref + indent, *msgs)
+def format_text(ir, text_format='offsets'):
+    pattern, width = TEXT_FORMATS[text_format]
+    indents = {}
+    lines = []
+    for inst in ir:
+        text = ' '.join(map(format_arg, inst.args))
+        if inst.offset is None:
+            lines.append(text)
+            continue
+        indent = indents.get(inst.depth)
+        if indent is None:
+            indent = indents[inst.depth] = ' ' * width * inst.depth
+        if pattern is None:
+            lines.append(indent + text)
+            continue
+        pref = pattern.format(inst.offset) + indent
+        lines.append(f'{pref} {text}' if inst.args else pref)
+    return lines
+
+
+def write_text(ir, out, text_format='offsets'):
+    lines = format_text(ir, text_format)
+    if lines:
+        out.write('\n'.join(lines))
+        out.write('\n')
+
+
+def write_ir(ir, out):
+    rows = (
+        [inst.offset, inst.depth, inst.opcode, encode_arg(inst.args), inst.refs]
+        for inst in ir
+    )
+    out.write('[\n')
+    out.write(',\n'.join(json.dumps(row) for row in rows))
+    out.write('\n]\n')
 
 
-def read_ext_item(items, index, ext_data, com_data):
-    offset, size, width, height, packed = items[index]
+def read_ir(stream):
+    return [
+        Instruction(offset, depth, opcode, decode_arg(args), [tuple(r) for r in refs])
+        for offset, depth, opcode, args, refs in json.load(stream)
+    ]
+
+
+STREAM_READERS = {
+    reads_uint8: BytecodeCursor.u8,
+    reads_uint16le: BytecodeCursor.u16,
+}
+
+
+def read_param(ctx, scf, param):
+    if param in STREAM_READERS:
+        return STREAM_READERS[param](scf)
+    return param(ctx, scf)
+
+
+def read_ext_item(ctx, index):
+    if ctx.ext is None:
+        raise ValueError('No EXT resources')
+    offset, size, width, height, packed = ctx.ext.items[index]
     if offset < 0:
-        print('NEGATIVE OFFSET')
-        if com_data is None:
-            raise ValueError('No commun data')
-        # TODO: handle different COMMUN.EX file for different TOTs
-        with io.BytesIO(com_data) as cstream:
-            assert ~offset == -(offset + 1)
-            cstream.seek(~offset)
-            if packed:
-                uncompressed_size = reads_uint32le(cstream)
-                return unpack_chunk(cstream, uncompressed_size)
-            else:
-                return cstream.read(size)
-    else:
-        with io.BytesIO(ext_data) as stream:
-            stream.seek(offset)
-            if packed:
-                uncompressed_size = reads_uint32le(stream)
-                return unpack_chunk(stream, uncompressed_size)
-            else:
-                return stream.read(size)
+        note(ctx, 'NEGATIVE OFFSET')
+    return ctx.ext.read(index)
 
 
 def menu():
@@ -1391,7 +1767,13 @@ def menu():
         default=['*.TOT'],
         help='script to decompile',
     )
-    parser.add_argument('version', help='script version to decompile', choices=optables.keys())
+    parser.add_argument(
+        '--optable',
+        '-o',
+        type=int,
+        choices=optables.keys(),
+        help='script version to decompile with, detected from the scripts by default',
+    )
     parser.add_argument(
         '--lang',
         '-l',
@@ -1407,9 +1789,54 @@ def menu():
         '--exported',
         '-e',
         action='store_true',
-        help='only decompile exported functions',
+        help='only decompile functions reachable from the exported ones',
+    )
+    parser.add_argument(
+        '--ir',
+        action='store_true',
+        help='also write decompiled instructions as JSON',
+    )
+    parser.add_argument(
+        '--xref',
+        action='store_true',
+        help='index variables, texts and resources used by each script',
+    )
+    parser.add_argument(
+        '--no-cache',
+        dest='cache',
+        action='store_false',
+        help='decompile every script again instead of reusing cached output',
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='print calls and time spent per opcode, and unknown opcodes',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='only decompile scripts that failed on the previous run',
+    )
+    parser.add_argument(
+        '--format',
+        dest='text_format',
+        choices=TEXT_FORMATS.keys(),
+        default='offsets',
+        help='layout of decompiled script lines',
+    )
+    parser.add_argument(
+        '--gzip',
+        dest='compress',
+        action='store_true',
+        help='write gzip compressed scripts',
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of worker processes to decompile scripts with',
     )
-
 
     return parser.parse_args()
 
@@ -1423,97 +1850,475 @@ optables = {
 }
 
 
-def main(gamedir, rebuild, scripts, lang=None, keys=False, exported=False):
-    game = archive.open_game(gamedir)
+class Coverage:
+    # disjoint sorted byte ranges of the decoded functions
+    def __init__(self) -> None:
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+
+    def add(self, start: int, end: int) -> None:
+        # merge with the ranges it overlaps or touches
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def next_gap(self, pos: int) -> int:
+        # first offset from `pos` that is not inside a decoded function
+        idx = bisect.bisect_right(self.starts, pos) - 1
+        if idx >= 0 and self.ends[idx] > pos:
+            return self.ends[idx]
+        return pos
+
+
+def decode_block(ctx, scf, start, ret_flag):
+    block = ctx.blocks[start] = Block(start, start)
+    outer = ctx.ir, ctx.indent, ctx.opcode
+    ctx.ir, ctx.indent, ctx.opcode = block.instructions, 0, None
+    ctx.block = block
+    scf.seek(start)
+    ctx.offset = start
+    try:
+        block_body(ctx, scf, ret_flag)
+    except Exception as exc:
+        skip_block(ctx, scf, start, exc)
+    finally:
+        ctx.ir, ctx.indent, ctx.opcode = outer
+        ctx.block = None
+    block.end = scf.tell()
+    return block
+
+
+def drain_blocks(ctx, scf, start):
+    # decode a function and every block nested in it, each block once
+    ctx.worklist.append((start, 2))
+    while ctx.worklist:
+        offset, ret_flag = ctx.worklist.pop()
+        if offset in ctx.blocks:
+            continue
+        queued = len(ctx.worklist)
+        decode_block(ctx, scf, offset, ret_flag)
+        # nested blocks are queued in file order, decode the first one next
+        ctx.worklist[queued:] = reversed(ctx.worklist[queued:])
+
+
+def flatten_block(ctx, start, depth=0):
+    # instructions of a block with its nested blocks spliced in place
+    block = ctx.blocks[start]
+    pos = 0
+    for index, nested_depth, nested in block.successors:
+        yield from shift_depth(block.instructions[pos:index], depth)
+        yield from flatten_block(ctx, nested, depth + nested_depth)
+        pos = index
+    yield from shift_depth(block.instructions[pos:], depth)
+
+
+def shift_depth(instructions, depth):
+    if not depth:
+        return instructions
+    return (replace(inst, depth=inst.depth + depth) for inst in instructions)
+
+
+def decompile(ctx, script, exported=False):
+    scfa = BytecodeCursor(bytes(script) + b'$')
+    covered = Coverage()
+
+    def decode_function(start):
+        ctx.offset = start
+        printl(ctx, f'sub_{start + 128} {{')
+        drain_blocks(ctx, scfa, start)
+        body = list(flatten_block(ctx, start))
+        ctx.ir.extend(body)
+        # callees are queued in the order their calls are printed
+        ctx.functions.extend(
+            int(name) for inst in body for kind, name, _ in inst.refs if kind == 'call'
+        )
+        end = ctx.blocks[start].end
+        covered.add(start, end)
+        ctx.offset = end
+        printl(ctx, '}')
+        note(ctx)
+
+    def follow_calls(pending):
+        # targets already decoded as a block of another function are skipped
+        while pending < len(ctx.functions):
+            func = ctx.functions[pending]
+            pending += 1
+            start = func - 128
+            if start in ctx.blocks:
+                continue
+            if not 0 <= start < len(script):
+                note(ctx, 'WARNING: call outside of script', func)
+                continue
+            decode_function(start)
+        return pending
+
+    note(ctx, list(ctx.functions))
+    pending = follow_calls(0)
+    if exported:
+        return
 
-    decoders = defaultdict(lambda: CodePageEncoder('cp850'))
-    decoders['ISR'] = CodePageEncoder('windows-1255')
-    decoders['KOR'] = CodePageEncoder('utf-8', errors='surrogateescape')
+    # code no call reaches is decoded in file order, along with its callees
+    pos = covered.next_gap(0)
+    while pos + 1 < len(script):
+        note(ctx, 'not reachable from exported functions')
+        decode_function(pos)
+        pending = follow_calls(pending)
+        pos = covered.next_gap(pos)
+
+
+def skip_block(ctx, scf, start, exc):
+    ctx.failures.append(
+        {
+            'block': start + 128,
+            'offset': ctx.offset + 128,
+            'error': f'{type(exc).__name__}: {exc}',
+        }
+    )
+    note(ctx, f'WARNING: failed to decode block_{start + 128}:', str(exc))
+    ctx.refs = []
 
-    if keys:
-        decoders['ISR'] = HebrewKeyReplacer
+    # resume after the block, or at the next known function
+    boundary = len(scf)
+    scf.seek(start)
+    if start + 4 <= len(scf) and scf.u8() == 1:
+        scf.u8()
+        boundary = start + scf.u16() + 2
+    later = [func - 128 for func in ctx.functions if func - 128 > start]
+    scf.seek(min([boundary, *later]))
 
-    if rebuild:
-        raise ValueError('Recompiler was not implemented yet')
 
-    com_data = {}
-    com_entry = None
-    for com_pattern, com_entry in game.search(['COMMUN.EX*']):
-        com_data[com_entry.name] = com_entry.read_bytes()
+DECOMPILER_VERSION = 10
+CACHE_DIR = '.cache'
 
-    ctx['com_data'] = com_data
-    ctx['com_entry'] = com_entry
 
-    # ctx['optable'] = optables[optable]
+def cache_key(tot_data, ext_data, texts, commun_digest=None, **options):
+    digest = hashlib.sha1(tot_data)
+    digest.update(ext_data or b'')
+    # resources loaded while decoding may come from the COMMUN files
+    params = [DECOMPILER_VERSION, tot_data[41], texts, commun_digest, options]
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
 
-    script_dir = Path('scripts')
-    os.makedirs(script_dir, exist_ok=True)
 
-    for pattern, entry in game.search(scripts):
+def failures_path(script_dir, name):
+    return script_dir / f'{name}.failures.json'
+
+
+def run_optable_path(script_dir):
+    return script_dir / CACHE_DIR / 'run.optable'
+
+
+def write_failures(script_dir, name, failures):
+    report = failures_path(script_dir, name)
+    if not failures:
+        report.unlink(missing_ok=True)
+        return
+    with report.open('w', encoding='utf-8') as stream:
+        json.dump({'script': name, 'failures': failures}, stream, indent=2)
+
+
+def write_script(
+    script_dir, name, instructions, ir=False, text_format='offsets', compress=False
+):
+    opener, suffix = (gzip.open, '.gz') if compress else (open, '')
+    script_out = script_dir / f'{name}.txt{suffix}'
+    with opener(script_out, 'wt', encoding='utf-8') as outstream:
+        write_text(instructions, outstream, text_format)
+    if ir:
+        ir_out = script_dir / f'{name}.json{suffix}'
+        with opener(ir_out, 'wt', encoding='utf-8') as outstream:
+            write_ir(instructions, outstream)
+
+
+def index_refs(script_dir, name, instructions):
+    xref.index_script(
+        script_dir / xref.INDEX_FILE,
+        name,
+        instructions,
+        {alias: var for var, alias in named_variables.items()},
+    )
+
+
+def load_entry(game, entry, keys=False):
+    decoders = text_codecs(keys)
+    commun = open_commun(game)
+
+    tot_data = entry.read_bytes()
+    tot_file = TotFile.from_bytes(tot_data)
+
+    ext = None
+    ext_data = None
+    for ext_pattern, ext_entry in game.search([entry.with_suffix('.EXT').name]):
+        ext_data = ext_entry.read_bytes()
+        ext = ResourceTable(
+            'EXT',
+            ext_data,
+            commun,
+            tot_file.im_file_number,
+            tot_file.ex_file_number,
+        )
+
+    texts = dict(
+        enumerate(
+            {lang: decrypt(decoders, line, lang) for lang in line}
+            for line in tot.write_parsed(game, entry)
+        )
+    )
+    return tot_data, tot_file, ext_data, ext, texts
 
+
+def exported_functions(tot_file):
+    return [x for x in tot_file.functions if x >= 128 and x != 0xFFFF]
+
+
+def trial_decode(tot_file, ext, texts, version):
+    # lower is better: (failed functions, warnings, -decoded instructions)
+    ctx = DecompilerContext(
+        optable=optables[version],
+        texts=texts,
+        ext=ext,
+        ver_script=version,
+        functions=exported_functions(tot_file),
+    )
+    decompile(ctx, tot_file.script, exported=True)
+    warnings = sum(
+        1
+        for inst in ctx.ir
+        if inst.offset is None and inst.args and str(inst.args[0]).startswith('WARNING')
+    )
+    decoded = sum(1 for inst in ctx.ir if inst.offset is not None)
+    return len(ctx.failures), warnings, -decoded
+
+
+DETECT_SAMPLE = 4
+
+
+def detect_optable(game, names, script_dir, keys=False, cache=True):
+    sample = sorted(names)[:DETECT_SAMPLE]
+    entries = [entry for pattern, entry in game.search(sample)]
+    loaded = [load_entry(game, entry, keys=keys) for entry in entries]
+    if not loaded:
+        return None
+
+    digest = hashlib.sha1(str(DECOMPILER_VERSION).encode('ascii'))
+    for tot_data, *_ in loaded:
+        digest.update(hashlib.sha1(tot_data).digest())
+    cache_path = script_dir / CACHE_DIR / f'{digest.hexdigest()}.optable'
+    if cache and cache_path.exists():
+        return int(cache_path.read_text())
+
+    declared = Counter(tot_file.script_version for _, tot_file, *_ in loaded)
+    scores = {}
+    for version in optables:
+        totals = [
+            trial_decode(tot_file, ext, texts, version)
+            for _, tot_file, _, ext, texts in loaded
+        ]
+        failed, warnings, decoded = map(sum, zip(*totals))
+        scores[version] = (failed, warnings, -declared[version], decoded)
+        print('optable', version, 'score', scores[version])
+    best = min(scores, key=scores.__getitem__)
+
+    if cache:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        cache_path.write_text(str(best))
+    return best
+
+
+def decompile_entry(
+    game,
+    entry,
+    script_dir,
+    lang=None,
+    keys=False,
+    exported=False,
+    optable=None,
+    ir=False,
+    xref=False,
+    cache=True,
+    stats=False,
+    text_format='offsets',
+    compress=False,
+):
+    output = {'text_format': text_format, 'compress': compress}
+    tot_data, tot_file, ext_data, ext, texts = load_entry(game, entry, keys=keys)
+    version = tot_file.script_version if optable is None else optable
+
+    cache_path = None
+    if cache:
+        key = cache_key(
+            tot_data,
+            ext_data,
+            texts,
+            commun_digest=ext.commun_digest() if ext is not None else None,
+            lang=lang,
+            exported=exported,
+            optable=version,
+        )
+        cache_path = script_dir / CACHE_DIR / f'{key}.json'
+        # statistics are only gathered by decoding
+        if cache_path.exists() and not stats:
+            with cache_path.open('r', encoding='utf-8') as stream:
+                instructions = read_ir(stream)
+            write_script(script_dir, entry.name, instructions, ir=ir, **output)
+            write_failures(script_dir, entry.name, [])
+            if xref:
+                index_refs(script_dir, entry.name, instructions)
+            return tot_file.script_version, tot_file.commun_handling, None
+
+    ctx = DecompilerContext(
+        optable=optables[version],
+        texts=texts,
+        ext=ext,
+        ver_script=version,
+        lang=lang,
+        functions=exported_functions(tot_file),
+        stats=OpcodeStats() if stats else None,
+    )
+    decompile(ctx, tot_file.script, exported=exported)
+    write_script(script_dir, entry.name, ctx.ir, ir=ir, **output)
+    write_failures(script_dir, entry.name, ctx.failures)
+    if ctx.failures:
+        print(f'warning: {entry.name}: {len(ctx.failures)} blocks failed to decode')
+
+    # failed scripts are decoded again on resume
+    if cache_path is not None and not ctx.failures:
+        os.makedirs(cache_path.parent, exist_ok=True)
+        # workers may race on identical scripts, publish complete files only
+        tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+        with tmp_path.open('w', encoding='utf-8') as stream:
+            write_ir(ctx.ir, stream)
+        os.replace(tmp_path, cache_path)
+    if xref:
+        index_refs(script_dir, entry.name, ctx.ir)
+    return tot_file.script_version, tot_file.commun_handling, ctx.stats
+
+
+def decompile_safe(game, entry, script_dir, **options):
+    try:
+        return decompile_entry(game, entry, script_dir, **options)
+    except Exception as exc:
+        print(f'warning: {entry.name}: {exc}')
+        error = {'block': None, 'offset': None, 'error': f'{type(exc).__name__}: {exc}'}
+        write_failures(script_dir, entry.name, [error])
+        return None
+
+
+def decompile_all(game, names, script_dir, **options):
+    for pattern, entry in game.search(names):
         print(f'Decompiling {entry.name}...')
-        texts_data = None
-        with entry.open('rb') as tot_file:
-            tot_data = tot_file.read()
-        
-        with io.BytesIO(tot_data) as tot_stream:
-            script, functions, texts_data, res_data, ifn, efn = read_tot(tot_stream)
+        yield entry.name, decompile_safe(game, entry, script_dir, **options)
+
+
+def decompile_batch(game, names, script_dir, **options):
+    versions = {}
+    for pattern, entry in game.search(names):
+        versions[entry.name] = decompile_safe(game, entry, script_dir, **options)
+    return [versions.get(name) for name in names]
+
+
+def main(
+    gamedir,
+    rebuild,
+    scripts,
+    lang=None,
+    keys=False,
+    exported=False,
+    optable=None,
+    ir=False,
+    xref=False,
+    cache=True,
+    stats=False,
+    resume=False,
+    text_format='offsets',
+    compress=False,
+    jobs=1,
+):
+    game = archive.open_game(gamedir)
 
-        tot_file = entry.read_bytes()
+    if rebuild:
+        raise ValueError('Recompiler was not implemented yet')
 
-        for ext_pattern, ext_entry in game.search([entry.with_suffix('.EXT').name]):
-            with ext_entry.open('rb') as ext_file:
-                ctx['ext_items'] = list(read_ext_table(ext_file))
-                ctx['ext_data'] = ext_file.read()
+    script_dir = Path('scripts')
+    os.makedirs(script_dir, exist_ok=True)
 
-        ctx['texts'] = dict(
-            enumerate(
-                {lang: decrypt(decoders, line, lang) for lang in line}
-                for line in tot.write_parsed(game, entry)
-            )
+    names = [entry.name for pattern, entry in game.search(scripts)]
+    names = list(dict.fromkeys(names))
+    selected = names
+    if resume:
+        selected = [name for name in names if failures_path(script_dir, name).exists()]
+        print(f'Resuming {len(selected)} failed scripts')
+
+    # resumed scripts are decoded with the table chosen for the full run
+    run_optable = run_optable_path(script_dir)
+    if optable is None and resume and run_optable.exists():
+        optable = int(run_optable.read_text())
+        print('Resuming with optable', optable)
+    if optable is None and selected:
+        optable = detect_optable(game, names, script_dir, keys=keys, cache=cache)
+        print('Detected optable', optable)
+    if optable is not None and not resume:
+        os.makedirs(run_optable.parent, exist_ok=True)
+        run_optable.write_text(str(optable))
+    names = selected
+
+    options = {
+        'optable': optable,
+        'lang': lang,
+        'keys': keys,
+        'exported': exported,
+        'ir': ir,
+        'xref': xref,
+        'cache': cache,
+        'stats': stats,
+        'text_format': text_format,
+        'compress': compress,
+    }
+    if jobs <= 1:
+        versions = decompile_all(game, names, script_dir, **options)
+    else:
+        chunk_size = max(1, -(-len(names) // (jobs * 4)))
+        chunks = [names[i : i + chunk_size] for i in range(0, len(names), chunk_size)]
+        print(f'Decompiling {len(names)} scripts with {jobs} workers...')
+        batches = parallel_map(
+            partial(decompile_batch, game, script_dir=script_dir, **options),
+            chunks,
+            jobs=jobs,
+        )
+        versions = (
+            (name, version)
+            for chunk, batch in zip(chunks, batches)
+            for name, version in zip(chunk, batch)
         )
 
-        # TODO: could it be used to automatically detect optable
-        prever = ctx.get('ver_script')
-        if prever is not None and prever != tot_file[41]:
-            print('warning: script version mismatch', prever, tot_file[41])
-        ctx['ver_script'] = tot_file[41]
-        print('script version', ctx['ver_script'], tot_file[0x3d])
-
-        ctx['optable'] = optables[ctx['ver_script']]
-
-        ctx['lang'] = lang
-
-        # print(ext_items)
-
-        # print(functions)
-        ctx['functions'] = [x for x in functions if x >= 128 and x != 0xFFFF]
-
-        def on_functions(scfa):
-            seen = set()
-            for func in ctx['functions']:
-                if func in seen:
-                    continue
-                scfa.seek(func - 128)
-                yield
-                seen.add(func)
-
-        def on_all_file(scfa):
-            while scfa.tell() + 1 < len(script):
-                yield
-
-        script_out = script_dir / f'{entry.name}.txt'
-        with (script_out).open('w', encoding='utf-8') as outstream:
-            with redirect_stdout(outstream):
-                print(ctx['functions'])
-                with io.BytesIO(script + b'$') as scfa:
-                    works_on = on_functions(scfa) if exported else on_all_file(scfa)
-                    for _ in works_on:
-                        ctx['offset'] = scfa.tell()
-                        printl(f'sub_{scfa.tell() + 128} {{')
-                        func_block(scfa, 2)
-                        printl('}')
-                        print()
+    prever = None
+    game_stats = OpcodeStats()
+    for name, version in versions:
+        if version is None:
+            continue
+        ver_script, commun_handling, script_stats = version
+        if prever is not None and prever != ver_script:
+            print('warning: script version mismatch', prever, ver_script)
+        if optable is not None and optable != ver_script:
+            print('warning: decompiled', name, 'with optable', optable)
+        prever = ver_script
+        print(name, 'script version', ver_script, commun_handling)
+        if script_stats is not None:
+            game_stats.update(script_stats, name)
+
+    if stats:
+        print_stats(game_stats)
+
+    failed = [name for name in names if failures_path(script_dir, name).exists()]
+    if failed:
+        print(
+            f'warning: {len(failed)} scripts had failures,',
+            f'see {script_dir}/*.failures.json and run again with --resume',
+        )
 
 
 if __name__ == '__main__':
@@ -1526,4 +2331,13 @@ if __name__ == '__main__':
         args.lang,
         args.keys,
         args.exported,
+        optable=args.optable,
+        ir=args.ir,
+        xref=args.xref,
+        cache=args.cache,
+        stats=args.stats,
+        resume=args.resume,
+        text_format=args.text_format,
+        compress=args.compress,
+        jobs=args.jobs,
     )
@@ -1,3 +1,6 @@
+from collections import defaultdict
+from functools import cache
+import hashlib
 import io
 import itertools
 from pathlib import Path
@@ -12,7 +15,7 @@ from boozook.codex.stk import unpack_chunk
 from boozook.codex.stk_compress import pack_content
 from boozook.grid import convert_to_pil_image
 
-from boozook.totfile import read_tot, reads_uint32le
+from boozook.totfile import TotFile, reads_uint32le
 
 
 def read_sint16le(f):
@@ -199,11 +202,247 @@ def read_ext_table(stream):
         yield (offset, size, width, height, packed)
 
 
-def parse(game: GameBase, entry: ArchivePath, target: str | Path):
+class CommunResources:
+    # Shared COMMUN.IM{n} / COMMUN.EX{n} files of a game, read and indexed on first use
+    def __init__(self, game: GameBase):
+        self.game = game
+        self._data: dict[str, bytes] = {}
+        self._im_tables: dict[str, np.ndarray] = {}
+        self._unpacked: dict[tuple[str, int], bytes] = {}
+        self._digests: dict[str, str | None] = {}
+
+    @staticmethod
+    def im_name(file_number: int) -> str:
+        return f'COMMUN.IM{file_number or 1}'
+
+    @staticmethod
+    def ex_name(file_number: int) -> str:
+        return f'COMMUN.EX{file_number}'
+
+    def _load(self, name: str) -> bytes:
+        if name not in self._data:
+            # archives are closed once the search moves on, read while still open
+            for _, entry in self.game.search([name]):
+                self._data[name] = entry.read_bytes()
+                break
+            else:
+                raise ValueError(f'entry {name} was not found in game')
+        return self._data[name]
+
+    def digest(self, name: str) -> str | None:
+        # content hash of a shared file, None when the game does not have it
+        if name not in self._digests:
+            try:
+                data = self._load(name)
+            except ValueError:
+                self._digests[name] = None
+            else:
+                self._digests[name] = hashlib.sha1(data).hexdigest()
+        return self._digests[name]
+
+    def im_item(self, file_number: int, index: int, size: int) -> memoryview:
+        name = self.im_name(file_number)
+        data = self._load(name)
+        if name not in self._im_tables:
+            self._im_tables[name] = np.frombuffer(
+                data, dtype='<u4', count=len(data) // 4
+            )
+        offset = int(self._im_tables[name][index])
+        return memoryview(data)[offset : offset + size]
+
+    def ex_item(
+        self, file_number: int, offset: int, size: int, packed: bool
+    ) -> bytes | memoryview:
+        name = self.ex_name(file_number)
+        data = self._load(name)
+        if packed:
+            key = (name, offset)
+            if key not in self._unpacked:
+                with io.BytesIO(data) as stream:
+                    stream.seek(offset)
+                    uncompressed_size = reads_uint32le(stream)
+                    self._unpacked[key] = unpack_chunk(stream, uncompressed_size)
+            return self._unpacked[key]
+        return memoryview(data)[offset : offset + size]
+
+
+def open_commun(game: GameBase) -> CommunResources:
+    if 'commun' not in game.cache:
+        game.cache['commun'] = CommunResources(game)
+    return game.cache['commun']
+
+
+class ResourceTable:
+    # Resource table of a TOT or EXT file, items are served by index
+    def __init__(
+        self,
+        kind: str,
+        data: bytes,
+        commun: CommunResources | None = None,
+        im_file_number: int = 0,
+        ex_file_number: int = 0,
+    ):
+        self.kind = kind
+        self.data = data if isinstance(data, bytes) else bytes(data)
+        self.commun = commun
+        self.im_file_number = im_file_number
+        self.ex_file_number = ex_file_number
+        with io.BytesIO(data) as f:
+            self.items = list(read_ext_table(f))
+            self.table_off = f.tell()
+        self._unpacked: dict[int, bytes] = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def commun_digest(self) -> str | None:
+        # items with negative offsets are served from a shared COMMUN file
+        if self.commun is None or all(item[0] >= 0 for item in self.items):
+            return None
+        if self.kind == 'TOT':
+            return self.commun.digest(self.commun.im_name(self.im_file_number))
+        return self.commun.digest(self.commun.ex_name(self.ex_file_number))
+
+    def raw(self, idx: int) -> memoryview:
+        offset, size, _, _, _ = self.items[idx]
+        assert offset >= 0, offset
+        start = self.table_off + offset
+        return memoryview(self.data)[start : start + size]
+
+    def read(self, idx: int) -> bytes | memoryview | None:
+        offset, size, width, height, packed = self.items[idx]
+        if offset < 0:
+            if self.commun is None:
+                raise ValueError('No commun data')
+            assert size > 0, size
+            assert ~offset == -(offset + 1)
+            if self.kind == 'TOT':
+                return self.commun.im_item(self.im_file_number, ~offset, size)
+            data = self.commun.ex_item(self.ex_file_number, ~offset, size, packed)
+            if not packed and len(data) != size:
+                print('WARNING: Reading EX out of bounds')
+                return None
+            return data
+        if not packed:
+            return self.raw(idx)
+        if idx not in self._unpacked:
+            with io.BytesIO(self.data) as stream:
+                stream.seek(self.table_off + offset)
+                uncompressed_size = reads_uint32le(stream)
+                self._unpacked[idx] = unpack_chunk(stream, uncompressed_size)
+        return self._unpacked[idx]
+
+
+def resolve_palettes(
+    tables: dict[str, ResourceTable],
+) -> dict[tuple[str, int], tuple[int, ...]]:
+    # palette items apply to the resources following them
+    palette = tuple(PALETTE)
+    palettes = {}
+    for ext, table in tables.items():
+        for idx, (offset, size, width, height, packed) in enumerate(table.items):
+            if offset >= 0 and packed and ext == 'TOT':
+                continue
+            if not (width and height):
+                data = table.read(idx)
+                if data is not None and len(data) == 768:
+                    palette = tuple((x << 2) % 256 for x in data)
+            palettes[ext, idx] = palette
+    return palettes
+
+
+@cache
+def palette_lut(palette: tuple[int, ...], mode: str = 'RGB') -> np.ndarray:
+    colors = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)
+    if mode == 'RGBA':
+        alpha = np.full((len(colors), 1), 255, dtype=np.uint8)
+        alpha[0] = 0
+        colors = np.hstack([colors, alpha])
+    return colors
+
+
+@cache
+def quantize_lut(palette: tuple[int, ...]) -> np.ndarray:
+    # nearest palette index for every color of the 6-bit VGA color cube
+    colors = np.asarray(palette, dtype=np.int32).reshape(-1, 3)
+    levels = np.arange(64, dtype=np.int32) << 2
+    cube = np.stack(
+        np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1
+    ).reshape(-1, 3)
+    norms = (colors**2).sum(axis=1)
+    lut = np.empty(len(cube), dtype=np.uint8)
+    step = 16384
+    for start in range(0, len(cube), step):
+        chunk = cube[start : start + step]
+        lut[start : start + step] = (norms - 2 * chunk @ colors.T).argmin(axis=1)
+    return lut
+
+
+def to_true_color(
+    frames: list[np.ndarray], palette: tuple[int, ...], mode: str = 'RGB'
+) -> list[np.ndarray]:
+    lut = palette_lut(palette, mode)
+    sizes = np.cumsum([frame.size for frame in frames])[:-1]
+    converted = lut[np.concatenate([frame.ravel() for frame in frames])]
+    return [
+        chunk.reshape(*frame.shape, -1)
+        for frame, chunk in zip(frames, np.split(converted, sizes))
+    ]
+
+
+def quantize(colors: np.ndarray, palette: tuple[int, ...]) -> np.ndarray:
+    rgb = colors[..., :3].astype(np.int32) >> 2
+    indices = quantize_lut(palette)[rgb[..., 0] << 12 | rgb[..., 1] << 6 | rgb[..., 2]]
+    if colors.shape[-1] == 4:
+        indices[colors[..., 3] == 0] = 0
+    return indices
+
+
+def read_indexed(
+    pic: Image.Image, orig, palette: tuple[int, ...], max_colors: int = 256
+) -> np.ndarray:
+    colors = np.asarray(pic)
+    orig = np.asarray(orig, dtype=np.uint8)
+    # only the first colors are reachable by sprites of lower bit depth
+    targets = palette[: 3 * max_colors]
+    if orig.size != colors.shape[0] * colors.shape[1]:
+        return quantize(colors, targets).ravel()
+    # keep original indices where the color is unchanged
+    orig = orig.reshape(colors.shape[:2])
+    changed = (palette_lut(palette, pic.mode)[orig] != colors).any(axis=-1)
+    indexed = orig.copy()
+    indexed[changed] = quantize(colors[changed], targets)
+    return indexed.ravel()
+
+
+def save_frames(frames, color_mode: str = 'P'):
+    if color_mode == 'P':
+        for image_path, frame, palette in frames:
+            bim = convert_to_pil_image(frame)
+            bim.putpalette(palette)
+            bim.save(image_path)
+        return
+
+    batches = defaultdict(list)
+    for image_path, frame, palette in frames:
+        batches[palette].append((image_path, frame))
+    for palette, batch in batches.items():
+        paths, indexed = zip(*batch)
+        for image_path, frame in zip(paths, to_true_color(indexed, palette, color_mode)):
+            Image.fromarray(frame).save(image_path)
+
+
+def parse(
+    game: GameBase,
+    entry: ArchivePath,
+    target: str | Path,
+    color_mode: str = 'P',
+):
     target = Path(target)
     reses = {}
     with entry.open('rb') as f:
-        _, _, _, res_data, ifn, efn = read_tot(f)
+        tot = TotFile(f)
+        res_data = tot.resources
     if res_data:
         reses['TOT'] = res_data
 
@@ -211,82 +450,48 @@ def parse(game: GameBase, entry: ArchivePath, target: str | Path):
         res_data = ext_entry.read_bytes()
         reses['EXT'] = res_data
 
-    com_data = {}
-    for com_pattern, com_entry in game.search(['COMMUN.EX*']):
-        com_data[com_entry.name] = com_entry.read_bytes()
-
-    im_data = {}
-    for im_patten, im_entry in game.search(['COMMUN.IM*']):
-        im_data[im_entry.name] = im_entry.read_bytes()
+    commun = open_commun(game)
+    tables = {
+        ext: ResourceTable(ext, res_data, commun, tot.im_file_number, tot.ex_file_number)
+        for ext, res_data in reses.items()
+    }
+    palettes = resolve_palettes(tables)
 
     bim = None
-    palette = list(PALETTE)
-    for ext, res_data in reses.items():
-        with io.BytesIO(res_data) as f:
-            items = list(read_ext_table(f))
-            table_off = f.tell()
-            for idx, (offset, size, width, height, packed) in enumerate(items):
-                if offset < 0:
-                    print('NEGATIVE OFFSET')
-                    if ext == 'TOT':
-                        print('IM RESOURCE')
-                        if ifn == 0:
-                            ifn = 1
-                        assert size > 0, size
-                        com_im = im_data[f'COMMUN.IM{ifn}']
-                        assert ~offset == -(offset + 1)
-                        xoffset = int.from_bytes(com_im[~offset * 4:~offset * 4 + 4], 'little')
-                        data = com_im[xoffset:xoffset+size]
-                    else:
-                        print('EX RESOURCE')
-                        com_im = com_data[f'COMMUN.EX{efn}']
-                        with io.BytesIO(com_im) as stream:
-                            assert ~offset == -(offset + 1)
-                            stream.seek(~offset)
-                            assert size > 0, size
-                            if packed:
-                                uncompressed_size = reads_uint32le(stream)
-                                data = unpack_chunk(stream, uncompressed_size)
-                            else:
-                                data = stream.read(size)
-                                if len(data) != size:
-                                    print('WARNING: Reading EX out of bounds')
-                                    continue
-                else:
-                    print('INLINE', ext, 'RESOURCE')
-                    assert f.tell() == offset + table_off, (
-                        f.tell(),
-                        offset + table_off,
-                    )
-                    if packed:
-                        if ext == 'TOT':
-                            continue
-                        uncompressed_size = reads_uint32le(f)
-                        data = unpack_chunk(f, uncompressed_size)
-                    else:
-                        data = f.read(size)
-                print('COMPRESSION', *data[:3])
-                if data[:2] == b'\x01\x02':
-                    print('UNCOMPRESS', entry.name, idx)
-                    im = uncompress_sprite(data[2:], width, height)
-                else:
-                    print('UNPACK', entry.name, idx)
-                    im = unpack_sprite(data, width, height)
-
-                image_path = target / f'{entry.stem}.{ext}_{idx}.png'
-                if width and height:
-                    bim = convert_to_pil_image(im, size=(width, height))
-                    bim.putpalette(palette)
-                    bim.save(image_path)
-                    print(image_path)
-                elif len(data) == 768:
-                    print('PALETTE', entry.name, idx)
-                    palette = [(x << 2) % 256 for x in data]
-                    if bim:
-                        bim.putpalette(palette)
-                        bim.save(image_path)
-                else:
-                    print(len(data), len(im))
+    frames = []
+    for ext, table in tables.items():
+        for idx, (offset, size, width, height, packed) in enumerate(table.items):
+            if offset < 0:
+                print('NEGATIVE OFFSET')
+                print('IM RESOURCE' if ext == 'TOT' else 'EX RESOURCE')
+            else:
+                print('INLINE', ext, 'RESOURCE')
+                if packed and ext == 'TOT':
+                    continue
+            data = table.read(idx)
+            if data is None:
+                continue
+            print('COMPRESSION', *data[:3])
+            if data[:2] == b'\x01\x02':
+                print('UNCOMPRESS', entry.name, idx)
+                im = uncompress_sprite(data[2:], width, height)
+            else:
+                print('UNPACK', entry.name, idx)
+                im = unpack_sprite(data, width, height)
+
+            image_path = target / f'{entry.stem}.{ext}_{idx}.png'
+            if width and height:
+                bim = np.asarray(im, dtype=np.uint8).reshape(height, width)
+                frames.append((image_path, bim, palettes[ext, idx]))
+                print(image_path)
+            elif len(data) == 768:
+                print('PALETTE', entry.name, idx)
+                if bim is not None:
+                    frames.append((image_path, bim, palettes[ext, idx]))
+            else:
+                print(len(data), len(im))
+
+    save_frames(frames, color_mode)
 
 
 def compress_sprite(data):
@@ -313,10 +518,11 @@ def compress_sprite(data):
 def compose(game: GameBase, entry: ArchivePath, target: str | Path):
     target = Path(target)
     reses = {}
-    with entry.open('rb') as f:
-        _, _, _, res_data, ifn, efn = read_tot(f)
-        if res_data:
-            reses['TOT'] = res_data
+    tot_data = entry.read_bytes()
+    tot = TotFile.from_bytes(tot_data)
+    res_data = tot.resources
+    if res_data:
+        reses['TOT'] = res_data
 
     for ext_pattern, ext_entry in game.search([entry.with_suffix('.EXT').name]):
         res_data = ext_entry.read_bytes()
@@ -327,96 +533,51 @@ def compose(game: GameBase, entry: ArchivePath, target: str | Path):
 
     assert res_data
 
+    tables = {
+        ext: ResourceTable(
+            ext, res_data, open_commun(game), tot.im_file_number, tot.ex_file_number
+        )
+        for ext, res_data in reses.items()
+    }
+    palettes = None
+
     for ext, res_data in reses.items():
 
         outfile = bytearray()
         outdata = bytearray()
 
         if ext == 'TOT':
-            with entry.open('rb') as f:
-                data = f.read()
-            outfile += data.replace(res_data, b'')
-            assert outfile + res_data == data
+            assert tot.resources_offset + len(res_data) == len(tot_data)
+            outfile += tot_data[: tot.resources_offset]
 
         outfile += res_data[:3]
 
-        with io.BytesIO(res_data) as f:
-            items = list(read_ext_table(f))
-            table_off = f.tell()
-
-            for idx, (offset, size, width, height, packed) in enumerate(items):
-                data = None
-                if offset < 0:
-                    outfile += b''.join(
-                        [
-                            offset.to_bytes(4, byteorder='little', signed=True),
-                            size.to_bytes(2, byteorder='little', signed=False),
-                            (width | 0x8000 * int(packed)).to_bytes(2, byteorder='little', signed=False),
-                            height.to_bytes(2, byteorder='little', signed=False),
-                        ]
-                    )
-                    continue
-                    raise ValueError('commun not supported for inject')
-                else:
-                    assert f.tell() == offset + table_off, (
-                        f.tell(),
-                        offset + table_off,
-                    )
-                    if packed:
-                        if ext == 'TOT':
-                            continue
-
-                        pos = f.tell()
-                        uncompressed_size = reads_uint32le(f)
-                        data = unpack_chunk(f, uncompressed_size)
-
-                        f.seek(pos)
-                        orig_data = f.read(size)
-                    else:
-                        data = f.read(size)
-
-                assert data is not None
-                offset = len(outdata)
-                inject_pic = target / f'{entry.stem}.{ext}_{idx}.png'
-                if not (inject_pic.exists() and width and height):
-                    if packed:
-                        data = orig_data  # pack_content(data)
-                    outdata += data
-                    outfile += b''.join(
-                        [
-                            offset.to_bytes(4, byteorder='little', signed=True),
-                            len(data).to_bytes(2, byteorder='little', signed=False),
-                            (width | 0x8000 * int(packed)).to_bytes(2, byteorder='little', signed=False),
-                            height.to_bytes(2, byteorder='little', signed=False),
-                        ]
-                    )
+        table = tables[ext]
+        for idx, (offset, size, width, height, packed) in enumerate(table.items):
+            data = None
+            if offset < 0:
+                outfile += b''.join(
+                    [
+                        offset.to_bytes(4, byteorder='little', signed=True),
+                        size.to_bytes(2, byteorder='little', signed=False),
+                        (width | 0x8000 * int(packed)).to_bytes(2, byteorder='little', signed=False),
+                        height.to_bytes(2, byteorder='little', signed=False),
+                    ]
+                )
+                continue
+                raise ValueError('commun not supported for inject')
+            else:
+                if packed and ext == 'TOT':
                     continue
+                data = table.read(idx)
+                orig_data = table.raw(idx)
 
-                im_data = np.asarray(Image.open(inject_pic)).ravel()
-                im_type = None
-
-                if data[:2] == b'\x01\x02':
-                    im_type = 'UNCOMPRESS'
-                    print(im_type, entry.name, idx)
-                    im = uncompress_sprite(data[2:], width, height)
-
-                else:
-                    im_type = 'UNPACK'
-                    print(im_type, entry.name, idx)
-                    im = unpack_sprite(data, width, height)
-
-                print(ext, inject_pic, width, height)
-
-                if not np.array_equal(im, im_data):
-                    if len(im_data) != width * height:
-                        raise ValueError(len(im_data), width * height)
-                    data = {
-                        'UNCOMPRESS': compress_sprite,
-                        'UNPACK': pack_sprite,
-                    }[im_type](im_data)
-
+            assert data is not None
+            offset = len(outdata)
+            inject_pic = target / f'{entry.stem}.{ext}_{idx}.png'
+            if not (inject_pic.exists() and width and height):
                 if packed:
-                    data = pack_content(data)
+                    data = orig_data  # pack_content(data)
                 outdata += data
                 outfile += b''.join(
                     [
@@ -426,6 +587,52 @@ def compose(game: GameBase, entry: ArchivePath, target: str | Path):
                         height.to_bytes(2, byteorder='little', signed=False),
                     ]
                 )
+                continue
+
+            im_type = None
+
+            if data[:2] == b'\x01\x02':
+                im_type = 'UNCOMPRESS'
+                print(im_type, entry.name, idx)
+                im = uncompress_sprite(data[2:], width, height)
+
+            else:
+                im_type = 'UNPACK'
+                print(im_type, entry.name, idx)
+                im = unpack_sprite(data, width, height)
+
+            with Image.open(inject_pic) as pic:
+                if pic.mode in ('RGB', 'RGBA'):
+                    if palettes is None:
+                        palettes = resolve_palettes(tables)
+                    max_colors = 16 if im_type == 'UNPACK' else 256
+                    im_data = read_indexed(
+                        pic, im, palettes[ext, idx], max_colors=max_colors
+                    )
+                else:
+                    im_data = np.asarray(pic).ravel()
+
+            print(ext, inject_pic, width, height)
+
+            if not np.array_equal(im, im_data):
+                if len(im_data) != width * height:
+                    raise ValueError(len(im_data), width * height)
+                data = {
+                    'UNCOMPRESS': compress_sprite,
+                    'UNPACK': pack_sprite,
+                }[im_type](im_data)
+
+            if packed:
+                data = pack_content(data)
+            outdata += data
+            outfile += b''.join(
+                [
+                    offset.to_bytes(4, byteorder='little', signed=True),
+                    len(data).to_bytes(2, byteorder='little', signed=False),
+                    (width | 0x8000 * int(packed)).to_bytes(2, byteorder='little', signed=False),
+                    height.to_bytes(2, byteorder='little', signed=False),
+                ]
+            )
 
         game.patch(f'{entry.stem}.{ext}', outfile + outdata)
 
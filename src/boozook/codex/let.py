@@ -7,7 +7,7 @@ from pakal.archive import ArchivePath
 import numpy as np
 
 
-from boozook.grid import create_char_grid, read_image_grid, resize_frame
+from boozook.grid import create_char_grid, read_image_grid, resize_frames
 
 
 def read_sint16le(stream):
@@ -27,12 +27,14 @@ def padarray(A, size):
     return np.pad(A, pad_width=(0, t), mode='constant')
 
 
+def encode_chars(glyphs):
+    # rows are padded to a multiple of 8 bits, same as read by decode_font
+    packed = np.packbits(glyphs == 1, axis=-1)
+    return [glyph.tobytes() for glyph in packed.reshape(len(packed), -1)]
+
+
 def encode_char(data, flags=0):
-    # TODO: align data width to multiple of 8
-    # data = np.hstack([data, np.zeros((16, 4), dtype=np.uint8)])
-    print(data.shape)
-    data = 1 * (data == 1)
-    return bytes(np.packbits(data).ravel().tolist())
+    return encode_chars(np.asarray(data)[None])[0]
 
 
 palette = [((53 + x) ** 2 * 13 // 5) % 256 for x in range(256 * 3)]
@@ -102,30 +104,36 @@ def compose(
     fname = target / f'{entry.name}.png'
     if not fname.exists():
         return
-    frames = read_image_grid(str(fname))
-    frames = enumerate(resize_frame(frame) for frame in frames)
-    available = [(idx, char) for idx, char in frames if char is not None]
-
-    print(available)
-
-    first_char, _ = available[0]
-    last_char, _ = available[-1]
-    height, width = available[0][1][1].shape
+    cells = read_image_grid(str(fname))
+    boxes, present = resize_frames(cells)
+    grid_size = len(cells)
+    boxes = boxes.reshape(-1, 4)
+    available = np.flatnonzero(present)
+
+    first_char = int(available[0])
+    last_char = int(available[-1])
+    x1, y1, x2, y2 = boxes[first_char]
+    height, width = int(y2 - y1), int(x2 - x1)
     print(height, width)
     print(first_char, last_char)
     char_range = range(first_char, last_char + 1)
-    assert len(char_range) == (last_char - first_char + 1)
-    encoded_chars = {idx: encode_char(char) for idx, (loc, char) in available}
 
-    nwidth = 8 * ((width + 7) // 8)
-    print((height, nwidth))
+    # crop all glyphs at once, each one from its own top-left corner
+    rows = boxes[available, 1, None] + np.arange(height)
+    cols = boxes[available, 0, None] + np.arange(width)
+    grid_rows, grid_cols = np.divmod(available, grid_size)
+    glyphs = cells[
+        grid_rows[:, None, None],
+        grid_cols[:, None, None],
+        rows[:, :, None],
+        cols[:, None, :],
+    ]
+    encoded_chars = dict(zip(available.tolist(), encode_chars(glyphs)))
 
-    spacer = encode_char(np.zeros((height, nwidth)))
+    spacer = encode_char(np.zeros((height, width)))
 
     with io.BytesIO() as output:
         output.write(bytes([width, height, first_char, last_char]))
-        for c in char_range:
-            output.write(encoded_chars.get(c, spacer))
-            print('DATA', c, encoded_chars.get(c, spacer))
+        output.write(b''.join(encoded_chars.get(c, spacer) for c in char_range))
 
         game.patch(entry.name, output.getvalue())
@@ -2,68 +2,83 @@ from collections import defaultdict
 from collections.abc import Iterator
 import io
 import itertools
+import re
 import struct
-from typing import cast
 from boozook.codex.base import write_uint16_le
 
 from boozook.codex.stk import replace_many
-from boozook.totfile import reads_uint16le
+
+
+HEX_ESCAPES = [f'\\x{v:02x}'.encode() for v in range(256)]
+
+# raw bytes replaced in the text files, '\n' is left for line breaks
+PLAIN_ESCAPES = {
+    **{bytes([i]): HEX_ESCAPES[i] for i in itertools.chain(range(10), [18])},
+    b'\t': b'|~t~|',
+    b'\r': b'|~r~|',
+}
+PLAIN_RE = re.compile(rb'[\x00-\x09\x0d\x12]')
+
+# control bytes, kept as hex escapes along with their operands
+CONTROL_RE = re.compile(rb'[\x01-\x0a]')
+CONTROL_OPERANDS = {3: 1, 4: 1, 7: 0, 8: 0, 9: 0}
+
+LINE_BREAKS_RE = re.compile(rb'\|~\$~\||\|~~~\|')
+HEX_SEQ_RE = re.compile(rb'\\x((?:(?!\\x).){0,2})', re.DOTALL)
 
 
 def escape(seq):
-    return b''.join(f'\\x{v:02x}'.encode() for v in seq)
-
-
-def escape_bytes(data):
-    with io.BytesIO(data) as stream:
-        while True:
-            r = stream.read(1)
-            if not r:
-                break
-            c = r[0]
-            if c == 1:
-                rest = stream.read(1)
-                if rest == b'\0':
-                    break
-                print(len(rest), stream.tell(), stream.tell() % 2)
-                print('REST', rest, stream.read())
-                yield escape(bytes([c]) + rest)
-                continue
-            if c in (2, 5):
-                xpos, ypos = reads_uint16le(stream), reads_uint16le(stream)
-                yield b'\n' if c == 2 else b'\n~~~\n'
-                yield f'{xpos}@{ypos}\n'.encode('ascii')
-                continue
-            if c in (3, 4):
-                yield escape(bytes([c]) + stream.read(1))
-                continue
-            if c == 6:
-                a = stream.read(1)[0]
-                skip = 0
-                if a & 0x80:
-                    skip += 2
-                elif a & 0x40:
-                    skip += 8
-                elif a & 0xC0:
-                    skip += 10
-                yield escape(bytes([c, a]) + stream.read(skip))
-                continue
-            if c in (7, 8, 9):
-                yield escape(bytes([c]))
-                continue
-            if c == 10:
-                a = stream.read(1)[0]
-                yield escape(bytes([c, a]) + stream.read(2 * a))
-            if c >= 0x80:
-                yield bytes([c])
-                continue
-            if c == 186:
-                raise NotImplementedError('Oy')
-            yield bytes([c])
-
-
-text_reps = [('\t', '|~t~|'), ('\r', '|~r~|')]
-bin_rep = [(chr(i), f'\\x{i:02x}') for i in itertools.chain(range(10), [18])]
+    return b''.join(HEX_ESCAPES[v] for v in seq)
+
+
+def escape_plain(data):
+    return PLAIN_RE.sub(lambda match: PLAIN_ESCAPES[match[0]], data)
+
+
+def escape_line(data):
+    data = bytes(data)
+    out = []
+    pos = 0
+    while match := CONTROL_RE.search(data, pos):
+        start = match.start()
+        out.append(escape_plain(data[pos:start]))
+        c = data[start]
+        pos = start + 1
+        if c in CONTROL_OPERANDS:
+            pos += CONTROL_OPERANDS[c]
+            out.append(escape(data[start:pos]))
+        elif c == 1:
+            rest = data[pos : pos + 1]
+            if rest != b'\0':
+                print('REST', rest, data[pos + 1 :])
+                out.append(escape(data[start : pos + 1]))
+            # anything after the end marker is dropped
+            return b''.join(out)
+        elif c in (2, 5):
+            xpos = int.from_bytes(data[pos : pos + 2], byteorder='little')
+            ypos = int.from_bytes(data[pos + 2 : pos + 4], byteorder='little')
+            pos += 4
+            out.append(b'\n' if c == 2 else b'\n~~~\n')
+            out.append(f'{xpos}@{ypos}\n'.encode('ascii'))
+        elif c == 6:
+            a = data[pos]
+            pos += 1 + (2 if a & 0x80 else 8 if a & 0x40 else 0)
+            out.append(escape(data[start:pos]))
+        else:
+            assert c == 10, c
+            pos += 1 + 2 * data[pos]
+            out.append(escape(data[start:pos]))
+            # the control byte itself is kept as well
+            out.append(b'\n')
+    out.append(escape_plain(data[pos:]))
+    return b''.join(out)
+
+
+def unescape_hex(match):
+    try:
+        return bytes([int(b'0x' + match[1], 16)])
+    except ValueError:
+        return match[1]
 
 
 def reencode(text):
@@ -75,39 +90,25 @@ def reencode(text):
         (b'|~t~|', b'\t'),
     )
     breaked = b''.join(build_line_breaks(escaped))
-    return b''.join(
-        encode_seq(i, seq)
-        for i, seq in enumerate(
-            breaked.split(b'\\x'),
-        )
-    )
+    return HEX_SEQ_RE.sub(unescape_hex, breaked)
 
 
-def extract_texts(sources: dict[str, dict[int, tuple[int, int, bytes]]], verify: bool = True) -> Iterator[dict[str, bytes | None]]:
+def extract_texts(sources: dict[str, dict[int, tuple[int, int, bytes]]], verify: bool = False) -> Iterator[dict[str, bytes | None]]:
     text_line_data: dict[int, dict[str, bytes | None]] = defaultdict(dict)
     for lang, texts in sources.items():
         for idx, (offset, size, line_data) in texts.items():
             text_line_data[idx][lang] = None
             if len(line_data) > 18 and line_data[18] not in {0, ord(b'@'), 4}:
                 # print('LINEDATA', list(line_data[:18]), line_data[18:])
-                escaped = b''.join(escape_bytes(line_data[18:]))
                 # TODO read and replace line
-                text = replace_many(
-                    escaped.decode('utf-8', errors='surrogateescape'),
-                    *text_reps,
-                    *bin_rep,
-                )
-                text_line_data[idx][lang] = text.encode(
-                    'utf-8',
-                    errors='surrogateescape',
-                )
+                text = escape_line(line_data[18:])
+                text_line_data[idx][lang] = text
 
                 if verify:
                     # when reading tsv file, escaped double quotes are converted
-                    escaped = cast(bytes, text_line_data[idx][lang])
-                    encoded = reencode(escaped)
-                    assert line_data[18:].startswith(encoded), (
-                        line_data[18:-2],
+                    encoded = reencode(text)
+                    assert line_data[18 : 18 + len(encoded)] == encoded, (
+                        bytes(line_data[18:-2]),
                         encoded,
                     )
 
@@ -116,34 +117,24 @@ def extract_texts(sources: dict[str, dict[int, tuple[int, int, bytes]]], verify:
 
 def build_line_breaks(lines):
     xpos, ypos = 0, 0
-    while True:
-        two, cont2 = None, lines
-        five, cont5 = None, lines
-        if b'|~$~|' in lines:
-            two, cont2 = lines.split(b'|~$~|', maxsplit=1)
-        if b'|~~~|' in lines:
-            five, cont5 = lines.split(b'|~~~|', maxsplit=1)
-
-        if two is None and five is None:
-            yield lines
-            return
-
-        if two is not None and (five is None or len(two) < len(five)):
-            yield two + b'\\x02'
-            pos, *lines = cont2.split(b'|~$~|', maxsplit=1)
-        else:
-            assert five is not None
-            yield five + b'\\x05'
-            pos, *lines = cont5.split(b'|~$~|', maxsplit=1)
+    start = 0
+    while match := LINE_BREAKS_RE.search(lines, start):
+        yield lines[start : match.start()] + (
+            b'\\x02' if match[0] == b'|~$~|' else b'\\x05'
+        )
+        cont = match.end()
+        end = lines.find(b'|~$~|', cont)
+        pos = lines[cont:] if end < 0 else lines[cont:end]
         try:
             xpos, ypos = (int(x) for x in pos.split(b'@', maxsplit=1))
         except ValueError:
             # Position is omitted, assume next multiple of 10 for ypos
             xpos, ypos = xpos, ypos + 10
-            lines = b'|~$~|'.join([pos, *lines])
+            start = cont
         else:
-            lines = b'|~$~|'.join([*lines])
+            start = len(lines) if end < 0 else end + len(b'|~$~|')
         yield write_uint16_le(xpos) + write_uint16_le(ypos)
+    yield lines[start:]
 
 
 def replace_texts(lines, texts, lang):
@@ -156,19 +147,10 @@ def replace_texts(lines, texts, lang):
         ):
             encoded = reencode(escaped)
             # assert line_data[18:].startswith(encoded), (line_data[18:-2], encoded)
-            line_data = line_data[:18] + encoded + b'\x01\x00'
+            line_data = bytes(line_data[:18]) + encoded + b'\x01\x00'
         yield offset, size, line_data
 
 
-def encode_seq(i, seq):
-    if not i:
-        return seq
-    try:
-        return bytes([int(b'0x' + seq[:2], 16)]) + seq[2:]
-    except Exception:
-        return seq
-
-
 def save_lang_file(out, texts):
     uint16le_x2 = struct.Struct('<2H')
     out.write(len(texts).to_bytes(2, byteorder='little', signed=False))
@@ -189,3 +171,47 @@ def save_lang_file(out, texts):
             # print('OFFSET', offset, line_data)
             out.write(uint16le_x2.pack(offset, size))
         out.write(outstream.getvalue())
+
+
+def synthetic_lines(count, seed=0):
+    import random
+
+    rand = random.Random(seed)
+    words = [b'Bonjour', b'le', b'monde', b'\x82t\x82', b'r\x82sum\x82', b'!', b'...']
+    for _ in range(count):
+        parts = []
+        for _ in range(rand.randint(1, 6)):
+            parts.append(b' '.join(rand.choices(words, k=rand.randint(1, 8))))
+            kind = rand.random()
+            if kind < 0.5:
+                pos = struct.pack('<2H', rand.randrange(320), rand.randrange(200))
+                parts.append((b'\x02' if kind < 0.4 else b'\x05') + pos)
+            elif kind < 0.7:
+                parts.append(bytes([3, rand.randrange(1, 16)]))
+            elif kind < 0.8:
+                parts.append(b'\x07')
+        yield bytes(18) + b''.join(parts) + b'\x01\x00'
+
+
+def bench(count=20000, repeat=5):
+    import timeit
+
+    lines = [line[18:] for line in synthetic_lines(count)]
+    escaped = [escape_line(line) for line in lines]
+    for line, text in zip(lines, escaped):
+        encoded = reencode(text)
+        assert line[: len(encoded)] == encoded, (line, encoded)
+
+    for name, func, corpus in (
+        ('escape', escape_line, lines),
+        ('reencode', reencode, escaped),
+    ):
+        timings = timeit.repeat(
+            lambda: [func(line) for line in corpus], number=1, repeat=repeat
+        )
+        best = min(timings)
+        print(f'{name}: {count} lines in {best:.3f}s ({count / best:,.0f} lines/s)')
+
+
+if __name__ == '__main__':
+    bench()
@@ -1,13 +1,14 @@
-from collections.abc import Iterator
+from collections import defaultdict
+from collections.abc import Iterator, Mapping
 import io
-import operator
-from itertools import groupby
+import itertools
 from pathlib import Path
 from typing import Iterable
 from boozook.archive import GameBase
+from boozook.codex.base import parallel_map
 from boozook.codex.cat import Language
 from boozook.codex.replace_tot import extract_texts, replace_texts, save_lang_file
-from boozook.totfile import fix_value, parse_text_data, read_tot, read_uint32le
+from boozook.totfile import TotFile, parse_text_data
 
 from pakal.archive import ArchivePath
 
@@ -16,83 +17,114 @@ def empty_lang(group, lang):
     return all(line[lang] is None for line in group)
 
 
-def compose(
-    game: GameBase,
-    lines: Iterable[tuple[str, dict[str, bytes | None]]],
-) -> None:
-    grouped = groupby(lines, key=operator.itemgetter(0))
-    for tfname, group in grouped:
-        basename = Path(tfname).name
-        cgroup = [t for _, t in group]
-        langs = list(cgroup[0].keys())
-        for pattern, entry in game.search([basename]):
-            texts = get_original_texts(game, entry)
-            available_langs = [lang for lang in langs if not empty_lang(cgroup, lang)]
-            backup = {
-                lang: lang if lang in texts
-                # else 'DAT'
-                else next((alang for alang in available_langs if alang != lang))
-                for lang in available_langs
-            }
-            new_texts = {
-                lang: dict(
-                    enumerate(replace_texts(iter(cgroup), texts[backup[lang]], lang))
+def compose_file(
+    tfname: str,
+    tot_data: bytes,
+    lang_data: dict[str, bytes],
+    cgroup: list[dict[str, bytes | None]],
+) -> list[tuple[str, bytes, str]]:
+    basename = Path(tfname).name
+    patches = []
+    tot = TotFile.from_bytes(tot_data)
+    texts = original_texts(tot.texts, lang_data)
+    langs = list(cgroup[0].keys())
+    available_langs = [lang for lang in langs if not empty_lang(cgroup, lang)]
+    backup = {
+        lang: lang if lang in texts
+        # else 'DAT'
+        else next((alang for alang in available_langs if alang != lang))
+        for lang in available_langs
+    }
+    new_texts = {
+        lang: dict(
+            enumerate(replace_texts(iter(cgroup), texts[backup[lang]], lang))
+        )
+        for lang in available_langs
+    }
+
+    for lang, lang_text in new_texts.items():
+        if lang == 'INT' and 'INT' not in texts:
+            continue
+        with io.BytesIO() as lang_out:
+            save_lang_file(lang_out, lang_text)
+            new_texts_data = lang_out.getvalue()
+        # assert texts_data == lang_text, (texts_data, lang_text)
+
+        parsed = dict(enumerate(parse_text_data(new_texts_data)))
+        assert parsed == lang_text, (parsed, lang_text)
+
+        if lang != 'INT':
+            patches.append(
+                (
+                    (
+                        f'{Path(tfname).stem}.{lang}'
+                        if lang in texts
+                        else f'{Path(tfname).stem}.{backup[lang]}'
+                    ),
+                    new_texts_data,
+                    f'{Path(tfname).stem}.{lang}',
                 )
-                for lang in available_langs
-            }
-
-            for lang, lang_text in new_texts.items():
-                if lang == 'INT' and 'INT' not in texts:
-                    continue
-                with io.BytesIO() as lang_out:
-                    save_lang_file(lang_out, lang_text)
-                    new_texts_data = lang_out.getvalue()
-                # assert texts_data == lang_text, (texts_data, lang_text)
-
-                parsed = dict(enumerate(parse_text_data(new_texts_data)))
-                assert parsed == lang_text, (parsed, lang_text)
-
-                if lang != 'INT':
-                    game.patch(
-                        (
-                            f'{Path(tfname).stem}.{lang}'
-                            if lang in texts
-                            else f'{Path(tfname).stem}.{backup[lang]}'
-                        ),
-                        new_texts_data,
-                        f'{Path(tfname).stem}.{lang}',
-                    )
-
-                else:
-                    orig_tot = bytearray(entry.read_bytes())
-                    with io.BytesIO() as lang_out:
-                        save_lang_file(lang_out, texts[backup[lang]])
-                        texts_data = lang_out.getvalue()
-                    assert texts_data in orig_tot, orig_tot
-                    orig_tot = orig_tot.replace(texts_data, new_texts_data)
-                    resoff = fix_value(read_uint32le(orig_tot[52:]), 0xFFFFFFFF, 0)
-                    if resoff != 0:
-                        orig_tot[52:56] = (
-                            resoff + len(new_texts_data) - len(texts_data)
-                        ).to_bytes(4, byteorder='little', signed=False)
-                    game.patch(basename, bytes(orig_tot))
-            break
+            )
+
         else:
-            raise ValueError(f'entry {basename} was not found')
+            patches.append((basename, tot.with_texts(new_texts_data), basename))
+    return patches
 
 
-def get_original_texts(
+def read_sources(
     game: GameBase,
-    entry: ArchivePath,
-) -> dict[str, dict[int, tuple[int, int, bytes]]]:
+    fnames: Iterable[str],
+) -> dict[str, tuple[bytes, dict[str, bytes]]]:
+    # single pass over the game for all TOT files and their language files
+    stems = {Path(fname).stem.upper() for fname in fnames}
+    tot_files = {}
+    lang_files: dict[str, dict[str, bytes]] = defaultdict(dict)
+    patterns = ['*.TOT', *(f'*.{lang.name}' for lang in Language)]
+    for pattern, entry in game.search(patterns):
+        stem = entry.stem.upper()
+        if stem not in stems:
+            continue
+        if pattern == '*.TOT':
+            # first match wins, as with a direct lookup
+            if stem not in tot_files:
+                tot_files[stem] = entry.read_bytes()
+        else:
+            lang_files[stem][entry.suffix[1:]] = entry.read_bytes()
+    return {
+        stem: (tot_data, lang_files[stem]) for stem, tot_data in tot_files.items()
+    }
+
+
+def compose(
+    game: GameBase,
+    lines: Mapping[str, list[dict[str, bytes | None]]],
+    jobs: int = 1,
+) -> None:
+    sources = read_sources(game, lines)
+    tfnames = list(lines)
+    for tfname in tfnames:
+        if Path(tfname).stem.upper() not in sources:
+            raise ValueError(f'entry {Path(tfname).name} was not found')
+
+    patches = parallel_map(
+        compose_file,
+        tfnames,
+        *zip(*(sources[Path(tfname).stem.upper()] for tfname in tfnames)),
+        (lines[tfname] for tfname in tfnames),
+        jobs=jobs,
+    )
+    for fname, data, alias in itertools.chain.from_iterable(patches):
+        game.patch(fname, data, alias)
+
+
+def original_texts(
+    texts_data: bytes | memoryview | None,
+    lang_data: dict[str, bytes],
+) -> dict[str, dict[int, tuple[int, int, bytes | memoryview]]]:
     sources = {}
-    with entry.open('rb') as stream:
-        _, _, texts_data, res_data, _, _ = read_tot(stream)
     if texts_data:
         sources['INT'] = texts_data
-    lang_patterns = [f'{entry.stem}.{ext.name}' for ext in Language]
-    for pattern, lang_file in game.search(lang_patterns):
-        sources[lang_file.suffix[1:]] = lang_file.read_bytes()
+    sources.update(lang_data)
 
     return {
         source: dict(enumerate(parse_text_data(texts_data)))
@@ -100,11 +132,26 @@ def get_original_texts(
     }
 
 
+def get_original_texts(
+    game: GameBase,
+    entry: ArchivePath,
+) -> dict[str, dict[int, tuple[int, int, bytes | memoryview]]]:
+    with entry.open('rb') as stream:
+        texts_data = TotFile(stream).texts
+    lang_patterns = [f'{entry.stem}.{ext.name}' for ext in Language]
+    lang_data = {
+        lang_file.suffix[1:]: lang_file.read_bytes()
+        for pattern, lang_file in game.search(lang_patterns)
+    }
+    return original_texts(texts_data, lang_data)
+
+
 def write_parsed(
     game: GameBase,
     entry: ArchivePath,
+    verify: bool = False,
 ) -> Iterator[dict[str, bytes | None]]:
     texts = get_original_texts(game, entry)
     if not texts:
         return
-    yield from extract_texts(texts)
+    yield from extract_texts(texts, verify=verify)
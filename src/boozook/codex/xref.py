@@ -0,0 +1,135 @@
+from collections.abc import Iterable, Iterator, Mapping
+from pathlib import Path
+import sqlite3
+
+
+INDEX_FILE = 'xref.sqlite'
+
+KINDS = ('var', 'text', 'resource', 'tot', 'sound', 'call')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS refs (
+    script TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    access TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS refs_name ON refs (kind, name);
+CREATE INDEX IF NOT EXISTS refs_script ON refs (script);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+'''
+
+
+def collect_refs(instructions: Iterable) -> Iterator[tuple[int, str, str, str]]:
+    # diagnostics have no offset, their references go to the previous line
+    offset = 0
+    for inst in instructions:
+        if inst.offset is not None:
+            offset = inst.offset
+        for kind, name, access in inst.refs:
+            yield offset, kind, name, access
+
+
+def connect(db_path: Path) -> sqlite3.Connection:
+    # parallel workers index their own scripts, wait for each other's commits
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def index_script(
+    db_path: Path,
+    script: str,
+    instructions: Iterable,
+    aliases: Mapping[str, str],
+) -> None:
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO aliases VALUES (?, ?)',
+                aliases.items(),
+            )
+            conn.execute('DELETE FROM refs WHERE script = ?', (script,))
+            conn.executemany(
+                'INSERT INTO refs VALUES (?, ?, ?, ?, ?)',
+                (
+                    (script, *ref)
+                    for ref in dict.fromkeys(collect_refs(instructions))
+                ),
+            )
+    finally:
+        conn.close()
+
+
+def query(
+    db_path: Path,
+    kind: str,
+    name: str,
+    access: str | None = None,
+    script: str | None = None,
+) -> list[tuple[str, int, str]]:
+    conn = connect(db_path)
+    try:
+        row = conn.execute(
+            'SELECT name FROM aliases WHERE alias = ?', (name,)
+        ).fetchone()
+        if row is not None:
+            name = row[0]
+        sql = 'SELECT script, offset, access FROM refs WHERE kind = ? AND name = ?'
+        params = [kind, name]
+        if access is not None:
+            sql += ' AND access = ?'
+            params.append(access)
+        if script is not None:
+            sql += ' AND script = ?'
+            params.append(script)
+        sql += ' ORDER BY script, offset'
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def menu():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='query cross references of decompiled scripts'
+    )
+    parser.add_argument('kind', choices=KINDS, help='kind of reference')
+    parser.add_argument(
+        'name',
+        help='variable, text id, resource id, script, sound or call offset',
+    )
+    parser.add_argument(
+        '--index',
+        '-i',
+        default=str(Path('scripts') / INDEX_FILE),
+        help='index file written by the decompiler',
+    )
+    parser.add_argument(
+        '--access',
+        '-a',
+        choices=('read', 'write'),
+        help='only list variable reads or writes',
+    )
+    parser.add_argument('--script', '-s', help='only list references in script')
+
+    return parser.parse_args()
+
+
+def main(index, kind, name, access=None, script=None):
+    if not Path(index).exists():
+        raise ValueError(f'No cross reference index at {index}')
+    for script, offset, access in query(Path(index), kind, name, access, script):
+        print(f'{script}\t[{offset:08d}]\t{access}')
+
+
+if __name__ == '__main__':
+    args = menu()
+
+    main(args.index, args.kind, args.name, args.access, args.script)
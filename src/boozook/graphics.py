@@ -9,11 +9,13 @@ GRAPHICS_PATTERNS = {
     '*.TOT': ('graphics', ext.parse, ext.compose),
 }
 
+COLOR_MODES = ('P', 'RGB', 'RGBA')
 
-def decode(game, patterns, target):
+
+def decode(game, patterns, target, color_mode='P'):
     for pattern, entry in game.search(patterns):
         _, parse, _ = patterns[pattern]
-        parse(game, entry, target)
+        parse(game, entry, target, color_mode=color_mode)
 
 
 def encode(game, patterns, target):
@@ -34,10 +36,17 @@ def menu():
         action='store_true',
         help='create modified game resource with the changes',
     )
+    parser.add_argument(
+        '--color-mode',
+        '-c',
+        choices=COLOR_MODES,
+        default='P',
+        help='color mode of extracted images',
+    )
     return parser.parse_args()
 
 
-def main(gamedir, rebuild):
+def main(gamedir, rebuild, color_mode='P'):
     patterns = GRAPHICS_PATTERNS
 
     target = Path('graphics')
@@ -45,7 +54,7 @@ def main(gamedir, rebuild):
 
     game = archive.open_game(gamedir)
     if not rebuild:
-        decode(game, patterns, target)
+        decode(game, patterns, target, color_mode=color_mode)
     else:
         encode(game, patterns, target)
 
@@ -53,4 +62,4 @@ def main(gamedir, rebuild):
 if __name__ == '__main__':
     args = menu()
 
-    main(args.directory, args.rebuild)
+    main(args.directory, args.rebuild, args.color_mode)
@@ -1,5 +1,3 @@
-import itertools
-
 import numpy as np
 from PIL import Image
 
@@ -21,36 +19,45 @@ def convert_to_pil_image(char, size=None):
     return im
 
 
-def get_bg_color(row_size, f, bgs=BGS):
-    def get_bg(idx):
-        return ord(bgs[f(idx) % len(bgs)])
-
-    return get_bg
-
-
 def read_image_grid(filename, w=TILE_W, h=TILE_H, grid_size=GRID_SIZE):
-    bim = Image.open(filename)
-
-    for row in range(grid_size):
-        for col in range(grid_size):
-            area = (col * w, row * h, (col + 1) * w, (row + 1) * h)
-            yield bim.crop(area)
+    with Image.open(filename) as bim:
+        frame = np.asarray(bim)
+    assert frame.shape[0] >= h * grid_size and frame.shape[1] >= w * grid_size
+    row_stride, col_stride = frame.strides[:2]
+    # view of shape (grid_size, grid_size, h, w) over the image buffer
+    return np.lib.stride_tricks.as_strided(
+        frame,
+        shape=(grid_size, grid_size, h, w),
+        strides=(h * row_stride, w * col_stride, row_stride, col_stride),
+        writeable=False,
+    )
 
 
-def checkered_grid(
+def checkered_canvas(
     nchars, w=TILE_W, h=TILE_H, grid_size=GRID_SIZE, transparency=0, bgs=BGS
 ):
     assert nchars <= grid_size**2, nchars
 
-    bim = convert_to_pil_image([[transparency] * w * grid_size] * h * grid_size)
-    get_bg = get_bg_color(grid_size, lambda idx: idx + int(idx / grid_size), bgs=bgs)
-
     # nchars does not have to match real number of characters nor max. index
-    for i in range(nchars):
-        ph = convert_to_pil_image([[get_bg(i)] * w] * h)
-        bim.paste(ph, box=((i % grid_size) * w, int(i / grid_size) * h))
+    idx = np.arange(grid_size**2)
+    colors = np.array([ord(bg) for bg in bgs], dtype=np.uint8)[
+        (idx + idx // grid_size) % len(bgs)
+    ]
+    colors[nchars:] = transparency
+
+    canvas = np.empty((grid_size, h, grid_size, w), dtype=np.uint8)
+    canvas[...] = colors.reshape(grid_size, 1, grid_size, 1)
+    return canvas.reshape(grid_size * h, grid_size * w)
+
 
-    return bim
+def checkered_grid(
+    nchars, w=TILE_W, h=TILE_H, grid_size=GRID_SIZE, transparency=0, bgs=BGS
+):
+    return convert_to_pil_image(
+        checkered_canvas(
+            nchars, w=w, h=h, grid_size=grid_size, transparency=transparency, bgs=bgs
+        )
+    )
 
 
 def create_char_grid(
@@ -64,7 +71,7 @@ def create_char_grid(
     transparency=0,
     bgs=BGS,
 ):
-    bim = checkered_grid(
+    canvas = checkered_canvas(
         nchars, w=w, h=h, grid_size=grid_size, transparency=transparency, bgs=bgs
     )
 
@@ -73,38 +80,41 @@ def create_char_grid(
         assert idx < nchars
         xbase = (idx % grid_size) * w + base_xoff
         ybase = (idx // grid_size) * h + base_yoff
-        bim.paste(convert_to_pil_image(im), box=(xbase, ybase))
-
-    return bim
+        char_h, char_w = np.shape(im)
+        canvas[ybase : ybase + char_h, xbase : xbase + char_w] = im
 
+    return convert_to_pil_image(canvas)
 
-def count_in_row(pred, row):
-    return sum(1 for _ in itertools.takewhile(pred, row))
 
+def resize_frames(frames):
+    # bounding boxes (x1, y1, x2, y2) of non background pixels for a stack of cells
+    h, w = frames.shape[-2:]
+    bg = frames[..., -1, -1]
+    mask = frames != bg[..., None, None]
+    cols = mask.any(axis=-2)
+    rows = mask.any(axis=-1)
 
-def resize_frame(im, base_xoff=BASE_XOFF, base_yoff=BASE_YOFF):
-    frame = list(np.asarray(im))
-    BG = frame[-1][-1]
-
-    char_is_bg = lambda c: c == BG
-    line_is_bg = lambda line: all(c == BG for c in line)
+    x1 = cols.argmax(axis=-1)
+    x2 = w - cols[..., ::-1].argmax(axis=-1)
+    y1 = rows.argmax(axis=-1)
+    y2 = h - rows[..., ::-1].argmax(axis=-1)
+    boxes = np.stack([x1, y1, x2, y2], axis=-1)
 
-    if set(itertools.chain.from_iterable(frame)) == {BG}:
-        return None
+    full = (x1 == 0) & (y1 == 0) & (x2 == w) & (y2 == h)
+    present = rows.any(axis=-1) & ~full
+    return boxes, present
 
-    x1 = min(count_in_row(char_is_bg, line) for line in frame)
-    x2 = len(frame[0]) - min(count_in_row(char_is_bg, reversed(line)) for line in frame)
-    y1 = count_in_row(line_is_bg, frame)
-    y2 = len(frame) - count_in_row(line_is_bg, reversed(frame))
 
-    crop_area = (x1, y1, x2, y2)
-
-    if crop_area == (0, 0, len(frame[0]), len(frame)):
+def resize_frame(im, base_xoff=BASE_XOFF, base_yoff=BASE_YOFF):
+    frame = np.asarray(im)
+    boxes, present = resize_frames(frame)
+    if not present:
         return None
 
+    x1, y1, x2, y2 = boxes.tolist()
     off_area = (x1 - base_xoff, y1 - base_yoff, x2 - base_xoff, y2 - base_yoff)
 
     fields = ('x1', 'y1', 'x2', 'y2')
     loc = dict(zip(fields, off_area))
 
-    return loc, np.asarray(im.crop(crop_area))
+    return loc, frame[y1:y2, x1:x2]
@@ -36,6 +36,20 @@ def texts_advanced(ctx: dict) -> dict:
     }
 
 
+def graphics_advanced(ctx: dict) -> dict:
+    color_mode = select_prompt(
+        'Which color mode to extract graphics in:',
+        [
+            Option('P', 'Paletted (original palette indices)'),
+            Option('RGB', 'True color (RGB)'),
+            Option('RGBA', 'True color with transparency (RGBA)'),
+        ],
+        multi_select=False,
+    )
+    assert isinstance(color_mode, SelectedOption)
+    return {'color_mode': color_mode.key}
+
+
 def scripts_advanced(ctx: dict) -> dict:
     session = PromptSession()
     scripts = session.prompt(
@@ -82,7 +96,7 @@ def interactive_menu(gamedir, experimental=False):
             Option('archive', 'Archives*', advanced=archive_advanced),
             Option('fonts', 'Fonts', selected=True),
             Option('texts', 'Texts*', selected=True, advanced=texts_advanced),
-            Option('graphics', 'Graphics'),
+            Option('graphics', 'Graphics*', advanced=graphics_advanced),
         ]
         if experimental:
             extract_options.append(
@@ -160,6 +174,19 @@ def menu(argv=None):
         action='store_true',
         help='replace text by keyboard key position',
     )
+    parser.add_argument(
+        '-m',
+        '--memory',
+        action='store_true',
+        help='edit texts as a translation memory with each unique text once',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='number of worker processes to use where supported',
+    )
 
     parser.add_argument(
         '-g',
@@ -167,6 +194,13 @@ def menu(argv=None):
         action='store_true',
         help='Extract or inject graphics.',
     )
+    parser.add_argument(
+        '-c',
+        '--color-mode',
+        choices=graphics.COLOR_MODES,
+        default='P',
+        help='color mode of extracted graphics (P keeps the game palette indices)',
+    )
     parser.add_argument(
         '-a',
         '--archive',
@@ -211,6 +245,45 @@ def menu(argv=None):
             help='(experimental) Only decompile exported functions.',
         )
 
+        parser.add_argument(
+            '--ir',
+            action='store_true',
+            help='(experimental) Also write decompiled instructions as JSON.',
+        )
+
+        parser.add_argument(
+            '--xref',
+            action='store_true',
+            help='(experimental) Index variables, texts and resources used by scripts.',
+        )
+
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            help='(experimental) Print opcode statistics of decompiled scripts.',
+        )
+
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='(experimental) Only decompile scripts that failed on the previous run.',
+        )
+
+        parser.add_argument(
+            '--format',
+            dest='text_format',
+            choices=decomp_tot.TEXT_FORMATS.keys(),
+            default='offsets',
+            help='(experimental) Layout of decompiled script lines.',
+        )
+
+        parser.add_argument(
+            '--gzip',
+            dest='compress',
+            action='store_true',
+            help='(experimental) Write gzip compressed scripts.',
+        )
+
         # parser.add_argument(
         #     '-o',
         #     '--optable',
@@ -249,17 +322,26 @@ def menu(argv=None):
         resources['texts'] = {
             'allowed': args.allowed or (),
             'keys': args.keys,
+            'jobs': args.jobs,
+            'memory': args.memory,
         }
     if args.fonts:
         resources['fonts'] = {}
     if args.graphics:
-        resources['graphics'] = {}
+        resources['graphics'] = {'color_mode': args.color_mode}
     if experimental and args.scripts:
         resources['scripts'] = {
             'lang': args.lang,
             'keys': args.keys,
             'scripts': args.scripts,
             'exported': args.exported,
+            'ir': args.ir,
+            'xref': args.xref,
+            'stats': args.stats,
+            'resume': args.resume,
+            'text_format': args.text_format,
+            'compress': args.compress,
+            'jobs': args.jobs,
             # 'optable': args.optable,
         }
     return ProgramArgs(
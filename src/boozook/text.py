@@ -1,20 +1,43 @@
 from collections import defaultdict
-from collections.abc import Callable, Iterable, Iterator, Sequence
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from contextlib import ExitStack
 import csv
+import hashlib
+from functools import partial
+import itertools
 import os
 from pathlib import Path
+from typing import TextIO
+import zlib
 
 from pakal.archive import ArchivePath
+import numpy as np
 
 from boozook.codex import cat, tot
+from boozook.codex.base import parallel_map
 from boozook import archive
-from boozook.codex.crypt import CodePageEncoder, HebrewKeyReplacer, TextEncoder, decrypt, encrypt
+from boozook.codex.crypt import CodePageEncoder, HebrewKeyReplacer, TextEncoder, encrypt
 
 
 LANGS = ['INT'] + [lang.name for lang in cat.Language]
 
+MEMORY_FILE = 'memory.tsv'
+UNITS_SUFFIX = '.units.tsv'
+SUMS_HEADER = '# codec '
+
+NGRAM_SIZE = 3
+SIMILARITY = 0.8
+MINHASH_BANDS = 8
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_CANDIDATES = 32
+MINHASH_A, MINHASH_B = np.random.default_rng(0).integers(
+    1, MINHASH_PRIME, size=(2, MINHASH_BANDS * 2), dtype=np.uint64
+)
+
 Decoder = Callable[[archive.GameBase, ArchivePath], Iterator[dict[str, bytes | None]]]
-Encoder = Callable[[archive.GameBase, Iterable[tuple[str, dict[str, bytes | None]]]], None]
+Encoder = Callable[
+    [archive.GameBase, Mapping[str, list[dict[str, bytes | None]]], int], None
+]
 
 TEXT_PATTERNS: dict[str, tuple[str, Decoder, Encoder]] = {
     '*.TOT': ('tot', tot.write_parsed, tot.compose),
@@ -39,52 +62,298 @@ def escape_quotes(text: str) -> str:
     return text.replace('"', '""')
 
 
+def format_row(fname: str, texts: Iterable[str]) -> str:
+    return '\t'.join([fname, *(f'"{escape_quotes(text)}"' for text in texts)]) + '\n'
+
+
+def decode_texts(
+    lines: Iterable[dict[str, bytes | None]],
+    crypts: dict[str, TextEncoder],
+) -> list[tuple[str, ...]]:
+    codecs = [(lang, crypts[lang]) for lang in LANGS]
+    return [
+        tuple(
+            '---' if (line := texts.get(lang)) is None else codec.decode(line)
+            for lang, codec in codecs
+        )
+        for texts in lines
+    ]
+
+
+def format_rows(
+    fname: str,
+    lines: Iterable[dict[str, bytes | None]],
+    crypts: dict[str, TextEncoder],
+) -> str:
+    return ''.join(format_row(fname, texts) for texts in decode_texts(lines, crypts))
+
+
+def digest_row(fname: str, texts: Iterable[str]) -> bytes:
+    # raw field values, as read back from the TSV on inject
+    return ('\t'.join([fname, *texts]) + '\n').encode('utf-8')
+
+
+def extract_rows(
+    fname: str,
+    lines: Iterable[dict[str, bytes | None]],
+    crypts: dict[str, TextEncoder],
+) -> tuple[list[tuple[str, ...]], bytes]:
+    texts = decode_texts(lines, crypts)
+    return texts, b''.join(digest_row(fname, row) for row in texts)
+
+
+def codec_digest(crypts: Mapping[str, TextEncoder]) -> str:
+    # texts decoded with other codecs encode to other bytes
+    settings = '\n'.join(repr(crypts[lang]) for lang in LANGS)
+    return hashlib.sha1(settings.encode('utf-8')).hexdigest()
+
+
+def read_sums(sums_file: Path) -> tuple[str | None, dict[str, str]]:
+    if not sums_file.exists():
+        return None, {}
+    with open(sums_file, 'r', encoding='utf-8') as stream:
+        header = stream.readline().rstrip('\n')
+        if not header.startswith(SUMS_HEADER):
+            return None, {}
+        return header.removeprefix(SUMS_HEADER), {
+            fname: digest
+            for digest, fname in (line.rstrip('\n').split('  ', 1) for line in stream)
+        }
+
+
+def write_sums(sums_file: Path, codec: str, sums: Mapping[str, str]) -> None:
+    with open(sums_file, 'w', encoding='utf-8') as stream:
+        stream.write(f'{SUMS_HEADER}{codec}\n')
+        for fname, digest in sums.items():
+            stream.write(f'{digest}  {fname}\n')
+
+
+def row_texts(row: Mapping[str, str | None]) -> tuple[str, ...]:
+    return tuple('---' if row.get(lang) is None else row[lang] for lang in LANGS)
+
+
+def unit_key(texts: Sequence[str]) -> str:
+    return hashlib.sha1('\t'.join(texts).encode('utf-8')).hexdigest()[:16]
+
+
+def ngram_hashes(text: str, size: int = NGRAM_SIZE) -> np.ndarray:
+    data = text.encode('utf-8')
+    grams = {data[i : i + size] for i in range(max(1, len(data) - size + 1))}
+    return np.fromiter((zlib.crc32(gram) for gram in grams), dtype=np.uint64)
+
+
+def near_duplicates(
+    texts: Sequence[str],
+    threshold: float = SIMILARITY,
+) -> dict[int, set[int]]:
+    # MinHash over hashed character n-grams, candidates share a band of the signature
+    grams = [ngram_hashes(text) for text in texts]
+    buckets: dict[tuple[int, bytes], list[int]] = defaultdict(list)
+    for idx, hashes in enumerate(grams):
+        permuted = (hashes[:, None] * MINHASH_A + MINHASH_B) % MINHASH_PRIME
+        signature = permuted.min(axis=0)
+        for band, rows in enumerate(signature.reshape(MINHASH_BANDS, -1)):
+            buckets[(band, rows.tobytes())].append(idx)
+
+    sets = [set(hashes.tolist()) for hashes in grams]
+    similar: dict[int, set[int]] = defaultdict(set)
+    for members in buckets.values():
+        # each text is compared with at most a few of the next ones by n-gram count,
+        # pairs with counts too far apart cannot reach the threshold
+        members = sorted(members, key=lambda idx: len(sets[idx]))
+        for pos, first in enumerate(members):
+            for second in members[pos + 1 : pos + 1 + MINHASH_CANDIDATES]:
+                if len(sets[first]) < threshold * len(sets[second]):
+                    break
+                if second in similar[first]:
+                    continue
+                common = len(sets[first] & sets[second])
+                if common >= threshold * len(sets[first] | sets[second]):
+                    similar[first].add(second)
+                    similar[second].add(first)
+    return similar
+
+
+def write_memory(
+    texts_dir: Path, occurrences: Mapping[tuple[str, ...], Sequence[str]]
+) -> None:
+    # one row per unique set of texts, with the game files it occurs in
+    units = list(occurrences)
+    keys = [unit_key(texts) for texts in units]
+    similar = near_duplicates(['\t'.join(texts) for texts in units])
+    with open(texts_dir / MEMORY_FILE, 'w', encoding='utf-8') as out:
+        out.write('\t'.join(['KEY', 'COUNT', 'SIMILAR', 'FILES', *LANGS]) + '\n')
+        for idx, texts in enumerate(units):
+            files = occurrences[texts]
+            info = [
+                keys[idx],
+                str(len(files)),
+                ','.join(keys[other] for other in sorted(similar.get(idx, ()))),
+                ','.join(dict.fromkeys(files)),
+            ]
+            out.write(format_row('\t'.join(info), texts))
+
+
+def read_memory(memory_file: Path) -> dict[str, dict[str, str | None]]:
+    if not memory_file.exists():
+        return {}
+    with open(memory_file, 'r', encoding='utf-8') as stream:
+        return {
+            row['KEY']: {lang: row.get(lang) for lang in LANGS}
+            for row in csv.DictReader(stream, delimiter='\t')
+        }
+
+
+def read_rows(
+    texts_dir: Path,
+    agg_file: str,
+    units: Mapping[str, dict[str, str | None]] | None = None,
+) -> list[dict[str, str | None]] | None:
+    if units is None:
+        text_file = texts_dir / (agg_file + '.tsv')
+        if not text_file.exists():
+            return None
+        with open(text_file, 'r', encoding='utf-8') as text_stream:
+            return list(csv.DictReader(text_stream, delimiter='\t'))
+
+    # rows of the translation memory are expanded to every occurrence
+    units_file = texts_dir / (agg_file + UNITS_SUFFIX)
+    if not units_file.exists():
+        return None
+    rows = []
+    with open(units_file, 'r', encoding='utf-8') as units_stream:
+        for row in csv.DictReader(units_stream, delimiter='\t'):
+            if row['KEY'] not in units:
+                raise ValueError(f'key {row["KEY"]} was not found in {MEMORY_FILE}')
+            rows.append({'FILE': row['FILE'], **units[row['KEY']]})
+    return rows
+
+
+def decode_batch(
+    game: archive.GameBase,
+    patterns: dict[str, tuple[str, Decoder, Encoder]],
+    names: Sequence[tuple[str, str]],
+    crypts: dict[str, TextEncoder],
+) -> list[tuple[list[tuple[str, ...]], bytes]]:
+    file_patterns = dict(names)
+    rows = {}
+    for fname, entry in game.search(list(file_patterns)):
+        _, parse, _ = patterns[file_patterns[fname]]
+        rows[fname] = extract_rows(entry.name, parse(game, entry), crypts)
+    return [rows.get(fname, ([], b'')) for fname, _ in names]
+
+
 def decode(
     game: archive.GameBase,
     patterns: dict[str, tuple[str, Decoder, Encoder]],
     texts_dir: Path,
     crypts: dict[str, TextEncoder],
+    jobs: int = 1,
+    memory: bool = False,
 ) -> None:
-    open_files = set()
-    for pattern, entry in game.search(patterns):
-        agg_file, parse, _ = patterns[pattern]
-        text_file = texts_dir / (agg_file + '.tsv')
-        mode = 'a' if agg_file in open_files else 'w'
-        with open(text_file, mode, encoding='utf-8') as out:
-            if mode == 'w':
-                print(
-                    'FILE',
-                    *LANGS,
-                    sep='\t',
-                    file=out,
+    # digest of the extracted rows of each file, to skip unchanged files on inject
+    digests = defaultdict(lambda: defaultdict(hashlib.sha1))
+    # with a translation memory, the files only list the key of each row
+    occurrences: dict[tuple[str, ...], list[str]] = defaultdict(list)
+    suffix, header = (UNITS_SUFFIX, ['KEY']) if memory else ('.tsv', LANGS)
+    with ExitStack() as stack:
+        open_files: dict[str, TextIO] = {}
+
+        def writer(agg_file: str) -> TextIO:
+            if agg_file not in open_files:
+                out = stack.enter_context(
+                    open(texts_dir / (agg_file + suffix), 'w', encoding='utf-8')
                 )
-            open_files.add(agg_file)
-            for texts in parse(game, entry):
-                print(
+                out.write('\t'.join(['FILE', *header]) + '\n')
+                open_files[agg_file] = out
+            return open_files[agg_file]
+
+        def write_rows(
+            agg_file: str, fname: str, texts: list[tuple[str, ...]], raw: bytes
+        ) -> None:
+            if memory:
+                for row in texts:
+                    occurrences[row].append(fname)
+                rows = ''.join(f'{fname}\t{unit_key(row)}\n' for row in texts)
+            else:
+                rows = ''.join(format_row(fname, row) for row in texts)
+            writer(agg_file).write(rows)
+            digests[agg_file][fname].update(raw)
+
+        if jobs <= 1:
+            for pattern, entry in game.search(patterns):
+                agg_file, parse, _ = patterns[pattern]
+                write_rows(
+                    agg_file,
                     entry.name,
-                    *(
-                        f'"{escape_quotes(decrypt(crypts, texts, lang))}"'
-                        for lang in LANGS
-                    ),
-                    sep='\t',
-                    file=out,
+                    *extract_rows(entry.name, parse(game, entry), crypts),
                 )
 
+        else:
+            names = [(entry.name, pattern) for pattern, entry in game.search(patterns)]
+            chunk_size = max(1, -(-len(names) // (jobs * 4)))
+            chunks = [
+                names[i : i + chunk_size] for i in range(0, len(names), chunk_size)
+            ]
+            batches = parallel_map(
+                decode_batch,
+                itertools.repeat(game),
+                itertools.repeat(patterns),
+                chunks,
+                itertools.repeat(crypts),
+                jobs=jobs,
+            )
+            # rows are written in search order regardless of completion order
+            for chunk, batch in zip(chunks, batches):
+                for (fname, pattern), (texts, raw) in zip(chunk, batch):
+                    agg_file, _, _ = patterns[pattern]
+                    write_rows(agg_file, fname, texts, raw)
+
+    for agg_file, file_digests in digests.items():
+        write_sums(
+            texts_dir / (agg_file + '.sums'),
+            codec_digest(crypts),
+            {fname: digest.hexdigest() for fname, digest in file_digests.items()},
+        )
+    if memory:
+        write_memory(texts_dir, occurrences)
+
 
 def encode(
     game: archive.GameBase,
     patterns: dict[str, tuple[str, Decoder, Encoder]],
     texts_dir: Path,
     crypts: dict[str, TextEncoder],
+    jobs: int = 1,
+    memory: bool = False,
 ) -> None:
+    # edits of the translation memory apply to every occurrence of the texts
+    units = read_memory(texts_dir / MEMORY_FILE) if memory else None
     encoders = set((name, composer) for _, (name, _, composer) in patterns.items())
     for agg_file, composer in encoders:
-        text_file = texts_dir / (agg_file + '.tsv')
-        if not text_file.exists():
+        rows = read_rows(texts_dir, agg_file, units)
+        if rows is None:
             continue
-        with open(text_file, 'r', encoding='utf-8') as text_stream:
-            tsv_reader = csv.DictReader(text_stream, delimiter='\t')
-            composer(game, encrypt_texts(crypts, tsv_reader))
+        # files whose rows match the digest taken at extract time are left as is,
+        # unless they were extracted with other codec settings
+        codec, sums = read_sums(texts_dir / (agg_file + '.sums'))
+        if codec != codec_digest(crypts):
+            sums = {}
+        digests = defaultdict(hashlib.sha1)
+        for row in rows:
+            digests[row['FILE']].update(digest_row(row['FILE'], row_texts(row)))
+        changed = {
+            fname
+            for fname, digest in digests.items()
+            if sums.get(fname) != digest.hexdigest()
+        }
+        # rows of the same file need not be contiguous in the TSV
+        index: dict[str, list[dict[str, bytes | None]]] = defaultdict(list)
+        for fname, text in encrypt_texts(crypts, rows):
+            if fname in changed:
+                index[fname].append(text)
+        if index:
+            composer(game, index, jobs)
     game.rebuild()
 
 
@@ -111,27 +380,63 @@ def menu():
         action='store_true',
         help='replace text by keyboard key position',
     )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of worker processes for extraction and injection',
+    )
+    parser.add_argument(
+        '--memory',
+        '-m',
+        action='store_true',
+        help='edit texts as a translation memory with each unique text once',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='check that extracted texts encode back to the original data',
+    )
     return parser.parse_args()
 
 
-def main(gamedir: str, rebuild: bool, allowed: Sequence[str]=(), keys: bool = False) -> None:
-    patterns = TEXT_PATTERNS
-
-    texts_dir = Path('texts')
-    os.makedirs(texts_dir, exist_ok=True)
-
-    decoders: dict[str, TextEncoder] = defaultdict(lambda: CodePageEncoder('cp850'))
+def text_codecs(keys: bool = False) -> dict[str, TextEncoder]:
+    decoders: dict[str, TextEncoder] = defaultdict(partial(CodePageEncoder, 'cp850'))
     decoders['ISR'] = CodePageEncoder('windows-1255')
     decoders['KOR'] = CodePageEncoder('utf-8', errors='surrogateescape')
 
     if keys:
         decoders['ISR'] = HebrewKeyReplacer
+    return decoders
+
+
+def main(
+    gamedir: str,
+    rebuild: bool,
+    allowed: Sequence[str] = (),
+    keys: bool = False,
+    jobs: int = 1,
+    verify: bool = False,
+    memory: bool = False,
+) -> None:
+    patterns = TEXT_PATTERNS
+    if verify:
+        patterns = {
+            **patterns,
+            '*.TOT': ('tot', partial(tot.write_parsed, verify=True), tot.compose),
+        }
+
+    texts_dir = Path('texts')
+    os.makedirs(texts_dir, exist_ok=True)
+
+    decoders = text_codecs(keys)
 
     game = archive.open_game(gamedir, allowed_patches=allowed or ())
     if not rebuild:
-        decode(game, patterns, texts_dir, decoders)
+        decode(game, patterns, texts_dir, decoders, jobs=jobs, memory=memory)
     else:
-        encode(game, patterns, texts_dir, decoders)
+        encode(game, patterns, texts_dir, decoders, jobs=jobs, memory=memory)
 
 
 if __name__ == '__main__':
@@ -142,4 +447,7 @@ if __name__ == '__main__':
         args.rebuild,
         allowed=args.allowed,
         keys=args.keys,
+        jobs=args.jobs,
+        verify=args.verify,
+        memory=args.memory,
     )
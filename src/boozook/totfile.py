@@ -1,5 +1,8 @@
 from collections.abc import Iterator
-import io
+from functools import cached_property
+import struct
+
+from boozook.codex.base import SupportsRead
 
 
 def read_uint16le(buffer):
@@ -22,82 +25,131 @@ def fix_value(original, target, fix):
     return original if original != target else fix
 
 
+class TotFile:
+    # Header is parsed once, script / texts / resources are read on first access
+    def __init__(self, stream: SupportsRead[bytes] | None = None, data: bytes | None = None):
+        self._stream = stream
+        self._data = memoryview(data) if data is not None else None
+        if self._data is not None:
+            self.header = bytes(self._data[:128])
+            self.file_size = len(self._data)
+        else:
+            assert stream is not None
+            stream.seek(0, 0)
+            self.header = stream.read(128)
+            stream.seek(0, 2)
+            self.file_size = stream.tell()
+
+        header = self.header
+        self.version = header[39:42].decode()
+        self.variables_count = read_uint32le(header[44:])
+        self.text_offset = fix_value(read_uint32le(header[48:]), 0xFFFFFFFF, 0)
+        self.resources_offset = fix_value(read_uint32le(header[52:]), 0xFFFFFFFF, 0)
+        self.anim_data_size = read_uint32le(header[56:])
+        self.im_file_number, self.ex_file_number, self.commun_handling = [
+            int(x) for x in header[59:62]
+        ]
+        self.functions = [read_uint16le(header[100 + 2 * i :]) for i in range(14)]
+
+        file_size = self.file_size
+        offsets = [x for x in (self.text_offset, self.resources_offset) if x > 0]
+        self.script_end = min(file_size, file_size, *offsets)
+
+        after_size = file_size - max(0, 0, *offsets)
+        before_size = max(0, 0, *offsets) - min(file_size, file_size, *offsets)
+
+        self.text_size, self.resources_size = (
+            (after_size, before_size)
+            if self.text_offset > self.resources_offset
+            else (before_size, after_size)
+        )
+
+        assert not (128 <= self.text_offset < self.script_end)
+        assert not (128 <= self.resources_offset < self.script_end)
+        if self.text_offset and self.resources_offset:
+            # texts are expected to be stored before resources
+            assert self.text_offset < self.resources_offset, (
+                self.text_offset,
+                self.resources_offset,
+            )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'TotFile':
+        return cls(data=data)
+
+    @property
+    def script_version(self) -> int:
+        return self.header[41]
+
+    def _section(self, offset: int, size: int) -> memoryview:
+        if self._data is not None:
+            return self._data[offset : offset + size]
+        assert self._stream is not None
+        self._stream.seek(offset, 0)
+        return memoryview(self._stream.read(size))
+
+    @cached_property
+    def script(self) -> memoryview:
+        return self._section(128, self.script_end - 128)
+
+    @cached_property
+    def texts(self) -> memoryview | None:
+        if self.text_offset == 0:
+            return None
+        return self._section(self.text_offset, self.text_size)
+
+    @cached_property
+    def resources(self) -> memoryview | None:
+        if self.resources_offset == 0:
+            return None
+        return self._section(self.resources_offset, self.resources_size)
+
+    def with_texts(self, texts_data: bytes) -> bytes:
+        # texts are replaced at their header offset, resources after them are moved
+        assert self._data is not None
+        assert 56 <= self.text_offset, self.text_offset
+        data = self._data
+        resources_offset = data[52:56]
+        if self.resources_offset:
+            shift = len(texts_data) - self.text_size
+            resources_offset = (self.resources_offset + shift).to_bytes(
+                4, byteorder='little', signed=False
+            )
+        return b''.join(
+            [
+                data[:52],
+                resources_offset,
+                data[56 : self.text_offset],
+                texts_data,
+                data[self.text_offset + self.text_size :],
+            ]
+        )
+
+
 def read_tot(stream):
-    header = stream.read(128)
-    _version = header[39:42].decode()
-    # print(float(_version))
-
-    _variables_count = read_uint32le(header[44:])
-    text_offset = fix_value(read_uint32le(header[48:]), 0xFFFFFFFF, 0)
-    resources_offset = fix_value(read_uint32le(header[52:]), 0xFFFFFFFF, 0)
-    _anim_data_size = read_uint32le(header[56:])
-    im_file_number, ex_file_number, _commun_handling = [int(x) for x in header[59:62]]
-
-    # print(
-    #   _variables_count,
-    #   text_offset,
-    #   resources_offset,
-    #   _anim_data_size,
-    #   im_file_number,
-    #   ex_file_number,
-    #   _commun_handling
-    # )
-
-    functions = [read_uint16le(header[100 + 2 * i :]) for i in range(14)]
-    stream.seek(0, 2)
-    file_size = stream.tell()
-
-    offsets = [x for x in (text_offset, resources_offset) if x > 0]
-    script_end = min(file_size, file_size, *offsets)
-
-    # print(functions)
-    # print(script_end)
-    after_size = file_size - max(0, 0, *offsets)
-    before_size = max(0, 0, *offsets) - min(file_size, file_size, *offsets)
-
-    text_size, resource_size = (
-        (after_size, before_size)
-        if text_offset > resources_offset
-        else (before_size, after_size)
+    tot = TotFile(stream)
+    texts = tot.texts
+    resources = tot.resources
+    return (
+        bytes(tot.script),
+        tot.functions,
+        bytes(texts) if texts is not None else None,
+        bytes(resources) if resources is not None else None,
+        tot.im_file_number,
+        tot.ex_file_number,
     )
 
-    stream.seek(128, 0)
-    script = stream.read(script_end - 128)
-    assert not (128 <= text_offset < script_end)
-    assert not (128 <= resources_offset < script_end)
-    texts = None
-    resources = None
-
-    if text_offset != 0:
-        assert stream.tell() == text_offset, (stream.tell(), text_offset)
-        stream.seek(text_offset, 0)
-        texts = stream.read(text_size)
-    if resources_offset != 0:
-        assert stream.tell() == resources_offset, (stream.tell(), resources_offset)
-        stream.seek(resources_offset, 0)
-        resources = stream.read(resource_size)
-        assert stream.read() == b''
-
-    # print(texts, resources)
-    return script, functions, texts, resources, im_file_number, ex_file_number
-
-
-def parse_text_data(data: bytes) -> Iterator[tuple[int, int, bytes]]:
-    with io.BytesIO(data) as stream:
-        items_count = reads_uint16le(stream)
-        # assert items_count == items_count & 0x3FFF  # assertion breaks with woodruff
-        items_count &= 0x3FF
-        # print(items_count)
-        index = [
-            (reads_uint16le(stream), reads_uint16le(stream)) for i in range(items_count)
-        ]
 
-        # print(index)
-        for offset, size in index:
-            if offset == 0xFFFF or size == 0:
-                yield offset, size, b''
-                continue
-            # assert stream.tell() in dict(index) or stream.tell() == len(data), (stream.tell(), index, len(data))
-            stream.seek(offset)
-            line_data = stream.read(size)
-            yield offset, size, line_data
+def parse_text_data(data: bytes) -> Iterator[tuple[int, int, bytes | memoryview]]:
+    view = memoryview(data)
+    items_count = read_uint16le(view)
+    # assert items_count == items_count & 0x3FFF  # assertion breaks with woodruff
+    items_count &= 0x3FF
+    # print(items_count)
+    index = struct.iter_unpack('<2H', view[2 : 2 + 4 * items_count])
+
+    for offset, size in index:
+        if offset == 0xFFFF or size == 0:
+            yield offset, size, b''
+            continue
+        yield offset, size, view[offset : offset + size]